@@ -1,17 +1,11 @@
+# matplotlib and scipy are only imported by the methods that need them, so importing the simulation (e.g. in every worker process) 
+# costs little more than numpy 
 import numpy as np 
-import matplotlib.pyplot as plt 
-import mpl_toolkits.mplot3d.axes3d as axes3d
-from time import time
-from math import exp, pi, cos, sin
-from scipy.stats import binned_statistic_2d as hist 
-from scipy.stats import multivariate_normal as gauss2D
-from scipy.stats import norm
-from scipy.stats import poisson
-from scipy.stats import rv_continuous
-from scipy.interpolate import interp1d as transform
-import scipy.integrate as integrate
-from skimage.filters import gaussian
+from math import pi
 import os
+from contextlib import nullcontext
+from event_store import open_event_store
+from dataset_writer import NOISE
 
 
 class beta_smearing(object):
@@ -39,25 +33,28 @@ class beta_smearing(object):
         
         # divide the distance travelled into discrete steps and find number of drift electrons produced at each step 
         chunked = self.chunking(decay_data[:,5], STEP_SIZE, decay_data[:,4])
-        number_deps = sum(chunked[:,1])
-        
+        num_steps = chunked[:,1].astype(np.int64)
+        number_deps = np.sum(num_steps)
+
+        # find direction vector of size equal to step size from initial and final location of every decay 
+        vec = f_locs - decay_data[:,0:3]
+        normed = np.linalg.norm(vec, axis = 1)
+        vec = (vec / normed[:,None]) * STEP_SIZE
+
+        # decay that each edep belongs to, and its step number j along that decay's track 
+        decay_idx = np.repeat(np.arange(NUM_DECAYS), num_steps)
+        first_idx = np.cumsum(num_steps) - num_steps
+        j = (np.arange(number_deps) - np.repeat(first_idx, num_steps)).astype(np.float32)
+
         # |X|Y|Z|Tpos|num|
+        # apply vector j times to the decay position to get each edep location 
         output_data = np.zeros((int(number_deps), 5), dtype=np.float32)
-        curr_idx = 0 
-        for i in range(NUM_DECAYS):
-            # find direction vector of size equal to step size from initial and final location 
-            vec = np.array((f_locs[i,0], f_locs[i,1], f_locs[i,2])) - np.array((decay_data[i,0], decay_data[i,1], decay_data[i,2]))
-            normed = np.linalg.norm(vec)
-            vec = (vec /normed) * STEP_SIZE
-            
-            # apply vector for required number of times to position to get each edep location 
-            for j in range(int(chunked[i,1])):
-                output_data[curr_idx, 0] = decay_data[i,0] + vec[0]*j
-                output_data[curr_idx, 1] = decay_data[i,1] + vec[1]*j
-                output_data[curr_idx, 2] = decay_data[i,2] + vec[2]*j
-                output_data[curr_idx, 3] = decay_data[i,3] 
-                output_data[curr_idx, 4] = chunked[i,2]
-                curr_idx += 1 
+        output_data[:,0:3] = decay_data[decay_idx,0:3] + vec[decay_idx] * j[:,None]
+        output_data[:,3]   = decay_data[decay_idx,3]
+        output_data[:,4]   = chunked[decay_idx,2]
+
+        # decay each edep came from, for callers that need to follow decays through the smearing 
+        self.smeared_from = decay_idx
         
         return output_data
 
@@ -67,6 +64,9 @@ class beta_smearing(object):
         create plots for demonstration/sanity checking purposes. 
         """
 
+        import matplotlib.pyplot as plt 
+        import mpl_toolkits.mplot3d.axes3d
+
         # create the figure 
         fig = plt.figure()
         ax = fig.add_subplot(1,1,1, projection = '3d')
@@ -100,13 +100,13 @@ class beta_smearing(object):
 
     def random_vector(self, distance, init_data):
         """
-        Create a random final location on surface of sphere, radius = distance travelled, centered on initial decay location. This method is not perfect - 'uniform' distribution 
-        is actually clustered around the poles of sphere. Need to upgrade to take into account integrals/surface elements etc...But it is good enough for now! 
+        Create a random final location on surface of sphere, radius = distance travelled, centered on initial decay location. Directions are 
+        uniform over the sphere: cos(theta) rather than theta is sampled uniformly, as the surface element is sin(theta) dtheta dphi. 
         """
 
         # spherical coordinates
-        theta = np.random.uniform(low = 0, high = pi, size = len(distance))
-        phi   = np.random.uniform(low = 0, high = 2*pi, size = len(distance))
+        theta = np.arccos(self.rng.uniform(low = -1, high = 1, size = len(distance)))
+        phi   = self.rng.uniform(low = 0, high = 2*pi, size = len(distance))
 
         # find x y z location 
         x = distance * np.sin(theta) * np.cos(phi)
@@ -134,44 +134,95 @@ class beta_smearing(object):
         #print('deposit data:', smeared_data)
         return smeared_data
 
+# tabulated beta decay spectrum CDFs keyed by Q-value, shared by every simulation in the process (see radiation_package.beta_cdf) 
+_beta_cdfs = {}
+
+# electronics response kernels of simulation.response_kernel, keyed on (sigma, truncate) 
+_response_kernels = {}
+
+# event store opened by the first simulation not given one, and shared by every later one in the process (see default_store) 
+_default_store = None
+
+
+def default_store():
+    """
+    The default event store, opened (and converted from electron_data.npy, on first use) once per process.
+    """
+
+    global _default_store
+    if _default_store is None:
+        _default_store = open_event_store()
+
+    return _default_store
+
+
+def float_key(value):
+    """
+    The exact bits of a float as a tuple of ints, to key a random stream on a parameter value.
+    """
+
+    return tuple(int(w) for w in np.frombuffer(np.float64(value).tobytes(), dtype = np.uint32))
+
+
 class radiation_package(beta_smearing):
     """
     This class contains the methods required to simulate the radiological background noise recorded during the event. Inherits beta_smearing class methods to 
     more accuractely model emitted beta particle contributions. 
     """
 
+    BETA_CACHE = None # directory to keep the tabulated beta spectra in between runs, None to rebuild them once per process 
+    AR39, K42  = 0, 1 # isotope codes of the radiodata isotope column 
+    verbose    = True # print the number of decays observed 
+
     def event_volume_rate(self, drift_times):
         """
         Take event data (populated), draw a volume cube around it and work out mean rate.
         """
 
-        # find max dims of event 
-        x_volume = max(self.event_data[:,0]) - min(self.event_data[:,0])
-        y_volume = max(self.event_data[:,1]) - min(self.event_data[:,1])
-        z_volume = max(self.event_data[:,2]) - min(self.event_data[:,2])
+        t_max = max(drift_times)                            # amount of time spanned by the event in micro seconds 
+        rateAr, rateK = self.volume_rates()
+        
+        # pass the mean rates to events_observed function 
+        return self.events_observed(rateAr, rateK, t_max) 
+
+    def volume_rates(self):
+        """
+        Mean number of Ar-39 and K-42 decays in a volume cube around the event (populated) during the event window.
+        """
 
-        vol           = 2 * x_volume * y_volume * z_volume  # double the volume of the event (arbitrary)
+        vol           = self.decay_volume()                 # mm^3 the decays are counted in 
         vol_module    = 7e12                                # volume of single phase module in mm^3
         rateAr_module = 10                                  # rate of decay in a module per micro second for Ar-39  
-        rateK_module  =  1e-3                               # rate of decay in a module per micro second for K-31 
-        t_max         = max(drift_times)                    # amount of time spanned by the event in micro seconds 
+        rateK_module  = self.activity                       # rate of decay in a module per micro second for K-42 
         
         # based on mean rate of Ar-39 find mean in that volume 
-        # within -500 to +500 micro seconds ... 
-        rateAr = rateAr_module * vol/vol_module * 1000
-        rateK = rateK_module * vol/vol_module * 1000
-        
-        # pass the mean rates to events_observed function 
-        return self.events_observed(rateAr, rateK, t_max) 
+        # within the decay time window (-500 to +500 micro seconds by default) ... 
+        rateAr = rateAr_module * vol/vol_module * (self.window[1] - self.window[0])
+        rateK = rateK_module * vol/vol_module * (self.window[1] - self.window[0])
+
+        return rateAr, rateK
+
+    def decay_volume(self):
+        """
+        Volume the decays are counted in: double the cube around the event. 
+        """
+
+        # find max dims of event 
+        x_volume = max(self.event_data[:,0]) - min(self.event_data[:,0])
+        y_volume = max(self.event_data[:,1]) - min(self.event_data[:,1])
+        z_volume = max(self.event_data[:,2]) - min(self.event_data[:,2])
+
+        return 2 * x_volume * y_volume * z_volume  # double the volume of the event (arbitrary)
 
     def events_observed(self, rateAr, rateK, t_max):
         """
         Given a mean rate, returns the number of observed events from a Poisson distribution.
         """
 
-        obs_eventsAr = poisson(rateAr).rvs(size = 1)
-        obs_eventsK = poisson(rateK).rvs(size = 1)
-        print('observed Ar: {}\nobserved K: {}'.format(obs_eventsAr, obs_eventsK))
+        obs_eventsAr = int(self.rng.poisson(rateAr))
+        obs_eventsK = int(self.rng.poisson(rateK))
+        if self.verbose == True:
+            print('observed Ar: {}\nobserved K: {}'.format(obs_eventsAr, obs_eventsK))
 
         # pass the number of decays observed to populate_radio_data function 
         return self.populate_radio_data(obs_eventsAr, obs_eventsK, t_max)
@@ -190,32 +241,73 @@ class radiation_package(beta_smearing):
     
     def beta_spect(self, q_value, num_events):
         """
-        Function creates and samples beta decay energy spectrum.
+        Function samples beta decay energy spectrum by inverse transform of its tabulated CDF.
+        """
+
+        energies, cdf = self.beta_cdf(q_value)
+
+        # sample distribution 
+        rand = np.interp(self.rng.uniform(size = num_events), cdf, energies)
+
+        return rand
+
+    def beta_cdf(self, q_value):
+        """
+        Returns the (energies, CDF) table of the beta decay spectrum with the given Q-value. The table is built once per Q-value and cached 
+        for the life of the process, and also on disk if BETA_CACHE is set to a directory.
         """
-        # define bounds 
-        a = 0 
-        b = q_value
 
-        # find normalised pdf 
+        if q_value in _beta_cdfs:
+            return _beta_cdfs[q_value]
+
+        path = None
+        if self.BETA_CACHE is not None:
+            path = os.path.join(self.BETA_CACHE, 'beta_cdf_{}.npy'.format(q_value))
+
+        if path is not None and os.path.isfile(path):
+            table = np.load(path)
+        else:
+            # find pdf 
+            if q_value == 3.5:
+                pdf = self.bd_K
+            else:
+                pdf = self.bd_Ar
+
+            # trapezoid rule cumulative integral over a fine energy grid, normalised to 1 at the Q-value 
+            energies = np.linspace(0, q_value, 2**14 + 1)
+            dens     = pdf(energies)
+            cdf      = np.concatenate(([0], np.cumsum(0.5 * (dens[1:] + dens[:-1]) * np.diff(energies))))
+            table    = np.stack((energies, cdf / cdf[-1]))
+
+            if path is not None:
+                os.makedirs(self.BETA_CACHE, exist_ok = True)
+                np.save(path, table)
+
+        _beta_cdfs[q_value] = (table[0], table[1])
+
+        return _beta_cdfs[q_value]
+
+    def beta_spect_check(self, q_value, num_events = 10**6, bins = 100):
+        """
+        Sanity check of the tabulated sampler against the analytic pdf. Returns the largest difference between the density histogram of 
+        num_events samples and the quad-normalised pdf at the bin centres, relative to the peak of the pdf. Not used by default.
+        """
+
+        import scipy.integrate as integrate
+
+        energies, cdf = self.beta_cdf(q_value)
+        rand = np.interp(np.random.default_rng(0).uniform(size = num_events), cdf, energies)
+
         if q_value == 3.5:
             pdf = self.bd_K
         else:
             pdf = self.bd_Ar
-        norm = integrate.quad(pdf, a, b)
-        
-        # create custom beta decay spectrum
-        class beta_decay(rv_continuous, radiation_package):
-            def _pdf(self, x):
-                if q_value == 3.5:
-                    return self.bd_K(x)/norm[0]
-                else: 
-                    return self.bd_Ar(x)/norm[0]
+        norm = integrate.quad(pdf, 0, q_value)
 
-        # sample distribution 
-        decay = beta_decay(a =a, b = b)
-        rand = decay.rvs(size = num_events)
+        density, edges = np.histogram(rand, bins = bins, range = (0, q_value), density = True)
+        expected = pdf(0.5 * (edges[1:] + edges[:-1])) / norm[0]
 
-        return rand
+        return np.amax(np.abs(density - expected)) / np.amax(expected)
 
     def ionisation_distance(self, energy):
         """
@@ -227,44 +319,42 @@ class radiation_package(beta_smearing):
     def  populate_radio_data(self, obs_eventsAr, obs_eventsK, t_max):
         """
         Function takes the number of observed events and populates an array with the 
-        emitted beta particle information: [x,y,z,E].
+        emitted beta particle information: [x,y,z,t,E,distance,isotope]. Distance is filled in by smear_master.
         """
 
         # create empty array to hold beta decay particle data 
-        total_events = obs_eventsK + obs_eventsAr
-        radiodata = np.zeros((int(total_events),6), dtype=np.float32) 
+        total_events = int(obs_eventsK + obs_eventsAr)
+        radiodata = np.zeros((total_events,7), dtype=np.float32) 
 
         # define the Q-values for each decay type - used to generate beta decay spectrums
         q_Ar = 0.6 # MeV
         q_K  = 3.5 # MeV 
         
         # sample from uniform distributions within the event volume cube to find x,y,z,t position of each decay 
-        x_vals = np.random.uniform(min(self.event_data[:,0]),max(self.event_data[:,0]), size = total_events)
-        y_vals = np.random.uniform(min(self.event_data[:,1]),max(self.event_data[:,1]), size = total_events)
-        z_vals = np.random.uniform(min(self.event_data[:,2]),max(self.event_data[:,2]), size = total_events)
-        t_vals = np.random.uniform(-500, 500, size = total_events)
+        x_vals = self.rng.uniform(min(self.event_data[:,0]),max(self.event_data[:,0]), size = total_events)
+        y_vals = self.rng.uniform(min(self.event_data[:,1]),max(self.event_data[:,1]), size = total_events)
+        z_vals = self.rng.uniform(min(self.event_data[:,2]),max(self.event_data[:,2]), size = total_events)
+        t_vals = self.rng.uniform(self.window[0], self.window[1], size = total_events)
         
         # sample beta decay spectrum to get the energy of each emitted beta particle  
         # calls beta_spect method defined above 
         e_spectAr = self.beta_spect(q_Ar, obs_eventsAr)
         e_spectK  = self.beta_spect(q_K, obs_eventsK) 
 
-        # populate radiodata with decay information
-        j = 0 
-        for i in range(int(total_events)):
-            radiodata[i,0] = x_vals[i]
-            radiodata[i,1] = y_vals[i]
-            radiodata[i,2] = z_vals[i]
-            radiodata[i,3] = t_vals[i]
-            try:
-                radiodata[i,4] = abs(e_spectAr[i]) #/ 23.6e-6
-            except: 
-                radiodata[i,4] = abs(e_spectK[j]) #/ 23.6e-6
-                j +=1
+        # populate radiodata with decay information, Ar-39 decays first followed by K-42 
+        radiodata[:,0] = x_vals
+        radiodata[:,1] = y_vals
+        radiodata[:,2] = z_vals
+        radiodata[:,3] = t_vals
+        radiodata[:,4] = np.abs(np.concatenate((e_spectAr, e_spectK))) #/ 23.6e-6
+        radiodata[:obs_eventsAr,6] = self.AR39
+        radiodata[obs_eventsAr:,6] = self.K42
         
         if self.SMEAR == True:
             # pass to the smearing class functions to get edep along the trajectory 
-            radiodata = self.smear_master(radiodata, total_events)
+            with self.stage('smearing') as record:
+                radiodata = self.smear_master(radiodata, total_events)
+                record['electrons'] = int(np.sum(radiodata[:,4]))
         else:
             radiodata[:,4] = radiodata[:,4] / 23.6e-6
         return radiodata 
@@ -277,128 +367,433 @@ class simulation(radiation_package):
     radiological activity.
     """
 
-    def __init__(self, event, screen,lifetime, t_coef, d_coef):
+    profiler = None # profiling.stage_profiler recording every stage, None to not profile 
+
+    def __init__(self, event, screen,lifetime, t_coef, d_coef, activity = 1e-3, store = None, binning = 'sample',  seed = 3, run = True, library = None, writer = None, 
+                 pitch = None, origin = None, max_memory = 2**28, profiler = None, verbose = True, resolution = None, active = True):
         
-        # load the neutrino event data produced by GEANT4 
-        electron_data    = np.load('electron_data.npy')
+        if profiler is not None:
+            self.profiler = profiler
+        self.verbose = verbose
 
-        # extract relevent data for specific event 
-        event_idx        = np.where(electron_data[:,5] == event)
-        event_idx        = event_idx[0]
+        # define simulation defaults/physics variables 
+        self.set_parameters(screen, lifetime, t_coef, d_coef, activity, binning, seed, pitch, origin, max_memory, resolution)
+        self.ACTIVE = active
 
-        # create empty array to store [x,y,z,edep] of event  
-        self.event_data  = np.zeros((len(event_idx), 4), dtype = np.float32) 
+        with self.stage('load') as record:
+            if isinstance(event, np.ndarray):
+                # the [x,y,z,edep] rows of an event passed in directly, which has no event ID 
+                electron_data, event = event, -1
+            else:
+                # the indexed GEANT4 event store shared by the process, unless one is passed in 
+                if store is None:
+                    store = default_store()
+
+                # zero-copy slice holding the [x,y,z,edep] rows of the specific event 
+                electron_data = store.get_event(event)
+
+            # create empty array to store [x,y,z,edep] of event  
+            self.event_data  = np.zeros((len(electron_data), 4), dtype = np.float32) 
+
+            # copy the edep locations and convert each edep to a number of drift electrons 
+            self.event_data[:,:3] = electron_data[:,:3]
+            self.event_data[:,3]  = electron_data[:,3] / self.ie
+            record['electrons'] = int(np.sum(self.event_data[:,3]))
+
+        self.event_num   = event                       # the event ID number used to identify specific neutrino event simulated (from GEANT4) 
+
+        # precomputed background tiles overlaid instead of simulating every decay, see background_library.py 
+        if isinstance(library, str):
+            from background_library import load_library
+            library = load_library(library)
+        self.library = library
+
+        # dataset_writer.shard_writer to append images to, or None to save each one as a JPEG 
+        self.writer = writer
+
+        # lifetime-independent stages, shared by every lifetime in a sweep 
+        self.drift_stage()
+
+        if run == True:
+            signal = self.lifetime_stage(lifetime)
+            self.result = signal
+        
+            #plot or save the TPC image 
+            self.plot_image(signal)
+
+    def set_parameters(self, screen, lifetime, t_coef, d_coef, activity = 1e-3, binning = 'sample', seed = 3, pitch = None, origin = None, 
+                       max_memory = 2**28, resolution = None):
+        """
+        Sets the simulation defaults/physics variables.
+        """
 
-        # define simulation defaults/physics variables 
         self.ie          = 23.6e-6                     # IE of argon in MeV 
         self.v           = 1.6                         # electron velocity in mm per micro second 
         self.screen      = screen                      # position of APA in mm relative to maximum edep position, relative to event origin in x-direction    
         self.lifetime    = lifetime                    # electron lifetime in micro seconds 
         self.noise       = 5                           # standard deviation of gaussian used to simulate thermal noise in electronics 
-        self.event_num   = event                       # the event ID number used to identify specific neutrino event simulated (from GEANT4) 
+        self.blur        = 2                           # standard deviation in time bins of the electronics response 
         self.t_coef      = t_coef                      # transverse diffusion coefficient 
         self.d_coef      = d_coef                      # longitudinal diffusion coefficient                        
-        np.random.seed(3)                              # may specify numpy random seed for reproducibility 
+        self.activity    = activity                    # K-42 decay rate per module per micro second 
+        self.seed        = seed                        # int or SeedSequence the random streams derive from, see random_stream 
         self.ACTIVE = True                             # if TRUE, simulate radiological noise 
         self.SMEAR = True                              # if TRUE, do not assume point deposition of beta decay energy - more accurate, but more time consuming 
-        
-        # create array to store drift times calculated for each edep in event 
-        drift_times = np.zeros((len(event_idx)))
-        bunch_screen_intercept = np.zeros((len(event_idx)))
+        self.SIGNAL = True                             # if FALSE, leave out the event's charge (and the (0,0) seed location) for a background-only image 
+        self.binning = binning                         # 'sample' bins every drift electron, 'expected' bins the analytic expected charge, 'poisson' Poisson fluctuates it 
+        self.pitch       = pitch                       # fixed wire pitch in mm, or None to spread the wires over each image's own electrons 
+        self.origin      = origin                      # y position in mm of the first wire's edge with a fixed pitch, or None to centre the wires on the event 
+        self.max_memory  = max_memory                  # bytes of electrons held at once when binning onto fixed wires 
+        self.window      = (-500, 500)                 # creation time window of radiological decays in micro seconds 
+        self.resolution  = resolution                  # (time bins, wires) of the output image, e.g. the CNN's (100,100), or None for the full 499 x 959 
+
+    def drift_stage(self):
+        """
+        Everything that does not depend on the electron lifetime: drift times, APA intercepts and diffusion stds of every edep, and the 
+        radiological decays drifted the same way. Random draws here come from stream 0 of seed.
+        """
 
-        # create array to hold the locations of each electron in edep bunch after diffusion effects are accounted for 
-        event_diffused_locs = np.zeros((1,2))
-        
-        # MAINLOOP
-        for i in range(len(event_idx)):
-            self.event_data[i,0] = electron_data[event_idx[i],0] 
-            self.event_data[i,1] = electron_data[event_idx[i],1] 
-            self.event_data[i,2] = electron_data[event_idx[i],2] 
-            self.event_data[i,3] = electron_data[event_idx[i],3] / self.ie
-
-            # work out each bunch-screen intercept and drift distance 
-            distance_travelled          = abs(self.screen - self.event_data[i,0])
-            drift_times[i]              = distance_travelled / self.v
-            intercept                   = self.calc_intercept(self.event_data[i,:3]) 
-            bunch_screen_intercept[i]   = intercept[1]
-            
-            # apply electron lifetime 
-            self.event_data[i,3] = self.electron_lifetime(self.event_data[i,3], drift_times[i])
-
-            # diffusion effects 
-            std_time, std_space       = self.diffusion_calcs(drift_times[i], distance_travelled)
-            cov                       = [[std_time**2,0], [0, std_space**2]]
-            self.mean                 = [drift_times[i], bunch_screen_intercept[i]]
-            bunch_diffused_locations  = np.random.multivariate_normal(mean = self.mean, cov = cov, size = int(self.event_data[i,3]))
-            event_diffused_locs       = np.concatenate((event_diffused_locs, bunch_diffused_locations))
-
-        if self.ACTIVE==True: 
-
-            # add in the radioactive noise clusters 
-            radiodata = self.event_volume_rate(drift_times)
-            radio_drift = np.zeros((len(radiodata[:,0])), dtype = np.float32)
-            bunch_screen_intercept = np.zeros((len(radiodata[:,1])))
-
-            for i in range(len(radio_drift)):
-
-                # populate drift times and find intercept points 
-                distance_travelled          = abs(self.screen - radiodata[i,0])
-                radio_drift[i]              = distance_travelled / self.v
-                intercept                   = self.calc_intercept(radiodata[i,:3]) 
-                bunch_screen_intercept[i]   = intercept[1]
-
-                # electron lifetime 
-                radiodata[i,4] = self.electron_lifetime(radiodata[i,4], radio_drift[i])
-                
-                # diffusion effects 
-                std_time, std_space       = self.diffusion_calcs(radio_drift[i], distance_travelled)
-                cov                       = [[std_time**2,0], [0, std_space**2]]
-                self.mean                 = [radio_drift[i], bunch_screen_intercept[i]]
-                bunch_diffused_locations  = np.random.multivariate_normal(mean = self.mean, cov = cov, size = int(radiodata[i,4]))
-
-                # add time of creation to drift time to get time hitting screen 
-                bunch_diffused_locations[:,0] += radiodata[i,3] 
-                event_diffused_locs       = np.concatenate((event_diffused_locs, bunch_diffused_locations))
-
-        # transform all the data points to +ve space for binning 
-        event_diffused_locs[:,1] = self.positive_transform(event_diffused_locs[:,1])
-        min_pos = min(event_diffused_locs[:,1])
-        max_pos = max(event_diffused_locs[:,1])
-
-        # normalise each position from 0->1 
-        space_range  = [min_pos, max_pos]
-        space_normed = [0, 1]
-        space_transform = transform(space_range, space_normed)
-        event_diffused_locs[:,1] = space_transform(event_diffused_locs[:,1])
-
-        # bin all the data according to the dimensions of the detector
-        t_max = np.amax(event_diffused_locs[:,0])
-        Xedge = np.arange(0, 1, 1/960)
-        Yedge = np.arange(-500, 500, 2)
+        self.rng = self.random_stream(0)
+
+        # drift times, bunch-screen intercepts and diffusion stds of every edep in one pass; attenuation is left to lifetime_stage 
+        with self.stage('transport') as record:
+            drift_times, intercepts, _, std_times, std_spaces = self.transport(self.event_data[:,:3], self.event_data[:,3])
+            record['electrons'] = int(np.sum(self.event_data[:,3]))
+
+        # mean arrival time/position, diffusion stds, unattenuated population and drift time of every bunch that drifts to the APA 
+        mean_times, mean_spaces, bunch_pops, bunch_drift = drift_times, intercepts[:,1], self.event_data[:,3], drift_times
+
+        if self.ACTIVE==True and self.library is None: 
+
+            with self.stage('radiological') as record:
+                # add in the radioactive noise clusters 
+                radiodata = self.event_volume_rate(drift_times)
+
+                # populate drift times, intercept points and diffusion stds of every decay step 
+                radio_drift, intercepts, _, radio_std_times, radio_std_spaces = self.transport(radiodata[:,:3], radiodata[:,4])
+                record['electrons'] = int(np.sum(radiodata[:,4]))
+
+            # add time of creation to drift time to get time hitting screen 
+            mean_times  = np.concatenate((mean_times, radio_drift + radiodata[:,3]))
+            mean_spaces = np.concatenate((mean_spaces, intercepts[:,1]))
+            std_times   = np.concatenate((std_times, radio_std_times))
+            std_spaces  = np.concatenate((std_spaces, radio_std_spaces))
+            bunch_pops  = np.concatenate((bunch_pops, radiodata[:,4]))
+            bunch_drift = np.concatenate((bunch_drift, radio_drift))
+
+        self.drifted = (mean_times, mean_spaces, std_times, std_spaces, bunch_pops, bunch_drift)
+
+    def lifetime_stage(self, lifetime):
+        """
+        Applies the electron lifetime to the drifted bunches and runs the stages after it (diffusion, binning, ADC conversion, blur and 
+        noise). Stream 1 of seed is restarted on every call, so each lifetime sees the same random numbers and an image from a sweep is 
+        identical to one from a standalone simulation at that lifetime. The event's and the background's charge are binned as separate 
+        layers, kept in self.layers, and summed before digitization. With SIGNAL off the signal layer is left empty, so the image holds 
+        only the background of the event's drift window.
+        """
+
+        self.lifetime = lifetime
+        self.rng = self.random_stream(1)
+
+        # the event's bunches come first, followed by any radiological ones 
+        mean_times, mean_spaces, std_times, std_spaces, bunch_pops, bunch_drift = self.drifted
+        n_event = len(self.event_data)
+        layer   = (np.arange(len(bunch_pops)) >= n_event).astype(np.int64)
+        if self.SIGNAL == False:
+            bunch_pops = np.where(layer == 0, 0, bunch_pops)
+
+        # apply electron lifetime 
+        bunch_pops = self.electron_lifetime(bunch_pops, bunch_drift)
+        self.bunches = (mean_times, mean_spaces, std_times, std_spaces, bunch_pops)
+
+        # wire positions are normalised over the image's own extent, or put on a fixed pitch 
+        space_range = self.wire_range()
+
+        # create TPC image (histogram with number of hits on each wire for each 2 micro second time interval), as [signal, background] layers 
+        if self.binning == 'sample' and space_range is None:
+
+            # locations of each electron in every bunch after diffusion effects are accounted for 
+            with self.stage('diffusion') as record:
+                event_diffused_locs = self.diffuse(*self.bunches)
+                record['electrons'] = self.num_electrons
+            with self.stage('binning') as record:
+                split  = 1 + int(np.sum(np.asarray(bunch_pops[:n_event]).astype(np.int64)))
+                layers = self.bin_electrons(event_diffused_locs, space_range, split)
+                record['electrons'] = self.num_electrons
+
+        elif self.binning == 'sample':
+
+            # the wires don't depend on the electrons, so they are drawn and binned a chunk at a time (one stage, diffusion included) 
+            with self.stage('binning') as record:
+                layers = self.accumulate_electrons(*self.bunches, space_range, images = layer, num_images = 2, seeded = [0])
+                record['electrons'] = self.num_electrons
+
+        elif self.binning in ('expected', 'poisson'):
+            with self.stage('binning') as record:
+                if space_range is None:
+                    space_range = self.expected_range(mean_spaces, std_spaces, bunch_pops)
+                layers = np.stack([self.expected_charge(*[b[layer == k] for b in self.bunches], space_range = space_range, 
+                                                        fluctuate = self.binning == 'poisson') for k in (0, 1)])
+                record['electrons'] = int(np.sum(np.asarray(bunch_pops).astype(np.int64)))
+
+        else:
+            raise ValueError('unknown binning mode {}'.format(self.binning))
+
+        if self.ACTIVE==True and self.library is not None:
+            with self.stage('background'):
+                layers[1] += self.overlay_background(layers[1].shape, space_range)
+
+        # all that is left of the signal layer is the (0,0) seed location 
+        if self.SIGNAL == False:
+            layers[0] = 0
+
+        self.layers = layers
+        self.space_range = space_range
+
+        with self.stage('digitize'):
+            return self.digitize(layers[0] + layers[1])
+
+    def background_layer(self, activity):
+        """
+        Binned charge of a fresh radiological background at the given activity, for the lifetime and wires of the last lifetime_stage, so 
+        it can be summed with that stage's signal layer (self.layers[0]). Its draws come from a stream keyed on the activity, so the 
+        layer of an activity is the same whatever other activities are simulated alongside it.
+        """
+
+        self.activity = activity
+        self.rng = self.random_stream(2, float_key(activity))
+        space_range = self.space_range
+
+        with self.stage('background') as record:
+            if self.library is not None:
+                return self.overlay_background(self.layers[0].shape, space_range)
+
+            # decays in the event volume, drifted and attenuated in one pass 
+            radiodata = self.event_volume_rate(self.drifted[5][:len(self.event_data)])
+            radio_drift, intercepts, bunch_pops, std_times, std_spaces = self.transport(radiodata[:,:3], radiodata[:,4])
+            bunches = (radio_drift + radiodata[:,3], intercepts[:,1], std_times, std_spaces, bunch_pops)
+            record['electrons'] = int(np.sum(np.asarray(bunch_pops).astype(np.int64)))
+
+            if self.binning == 'sample':
+                return self.accumulate_electrons(*bunches, space_range, images = np.zeros(len(bunch_pops), dtype = np.int64), num_images = 1, 
+                                                 seeded = [])[0]
+
+            return self.expected_charge(*bunches, space_range = space_range, fluctuate = self.binning == 'poisson')
+
+    def composite(self, background, activity):
+        """
+        Digitizes the last lifetime_stage's signal layer plus a background layer, with noise from a stream keyed on the activity. 
+        """
+
+        self.rng = self.random_stream(3, float_key(activity))
+
+        with self.stage('digitize'):
+            return self.digitize(self.layers[0] + background)
+
+    def stage(self, name):
+        """
+        Context manager timing a stage with the profiler, if there is one. Yields the stage's record, which the stage can add counts to.
+        """
+
+        if self.profiler is None:
+            return nullcontext({})
+
+        return self.profiler.stage(name)
+
+    def grid(self):
+        """
+        Binning grid of the image: its (time bins, wires), the width of a time bin in micro seconds and the width of a wire as a fraction
+        of the wire range. The full grid is 499 bins of 2 micro seconds from -500 by 959 wires of 1/960 of the range. A coarser
+        resolution spans the same time and wire extent with fewer, wider bins, so each output pixel holds the charge of the block of
+        full resolution pixels it covers.
+        """
+
+        if self.resolution is None:
+            return 499, 959, 2, 1/960
+
+        n_t, n_w = self.resolution
+
+        return n_t, n_w, 998 / n_t, 959 / (960 * n_w)
+
+    def pixel_scale(self):
+        """
+        Number of full resolution pixels an output pixel covers, and how many full resolution time bins its time bin spans.
+        """
+
+        if self.resolution is None:
+            return 1, 1
+
+        n_t, n_w, t_width, w_width = self.grid()
+
+        return (t_width / 2) * (w_width * 960), t_width / 2
+
+    def wire_range(self):
+        """
+        Fixed wire range of the image, or None to normalise the wires over the image's own electrons. A background library fixes the 
+        pitch to its own; otherwise self.pitch does, starting at self.origin or centred on the event.
+        """
+
+        if self.library is not None:
+            return self.library_space_range()
+
+        if self.pitch is None:
+            return None
+
+        if self.origin is None:
+            return self.centred_range(self.pitch)
+
+        return [self.origin, self.origin + 960*self.pitch]
+
+    def centred_range(self, pitch):
+        """
+        Wire range of the given pitch centred on the event in y. 
+        """
+
+        centre = 0.5 * (np.amin(self.event_data[:,1]) + np.amax(self.event_data[:,1]))
+
+        return [centre - 480*pitch, centre + 480*pitch]
+
+    def library_space_range(self):
+        """
+        Wire range giving the image the fixed wire pitch of the background library, centred on the event. The library tiles were made 
+        for one electron lifetime and diffusion setting, so a mismatch is an error.
+        """
+
+        for name in ('lifetime', 't_coef', 'd_coef'):
+            if not np.isclose(self.library[name], getattr(self, name)):
+                raise ValueError('background library has {} = {}, simulation has {}'.format(name, self.library[name], getattr(self, name)))
+
+        if 'depths' not in self.library:
+            raise ValueError('background library has no tile depths, rebuild it with build_library')
+
+        if self.pitch is not None and not np.isclose(self.library['pitch'], self.pitch):
+            raise ValueError('background library has pitch = {}, simulation has {}'.format(self.library['pitch'], self.pitch))
+
+        return self.centred_range(float(self.library['pitch']))
+
+    def overlay_background(self, shape, space_range):
+        """
+        Radiological background from the library: the number of Ar-39 and K-42 decays is drawn from the event_volume_rate Poisson 
+        expectation, and each decay is given a depth as in populate_radio_data (uniform over the event in x). The tile of its isotope 
+        built nearest that depth is added for each, shifted to a random creation time and wire position, so the tiles are attenuated 
+        and diffused as the decays they stand in for would be. The tiles are full resolution, so at a coarser resolution each tile 
+        pixel is pooled into the output pixel holding its centre.
+        """
+
+        library = self.library
+        n_t, n_w = 499, 959
+        rateAr, rateK = self.volume_rates()
+
+        # decays of each isotope, their drift distances and the tile picked for each 
+        num_Ar, num_K = self.rng.poisson(rateAr), self.rng.poisson(rateK)
+        x_vals = self.rng.uniform(np.amin(self.event_data[:,0]), np.amax(self.event_data[:,0]), size = num_Ar + num_K)
+        depths = np.abs(self.screen - x_vals)
+        picks  = np.concatenate((self.nearest_tiles(self.AR39, depths[:num_Ar]), self.nearest_tiles(self.K42, depths[num_Ar:])))
+
+        # creation time bin and wire of each decay, uniform in time and over the event in y as in populate_radio_data 
+        t_shift = np.floor((self.rng.uniform(self.window[0], self.window[1], size = len(picks)) + 500) / 2).astype(np.int64)
+        y_vals  = self.rng.uniform(np.amin(self.event_data[:,1]), np.amax(self.event_data[:,1]), size = len(picks))
+        w_shift = np.floor((y_vals - space_range[0]) / float(library['pitch'])).astype(np.int64)
+
+        # local (row, column) of every pixel of every picked tile 
+        heights, widths = library['shapes'][picks,0], library['shapes'][picks,1]
+        sizes   = heights * widths
+        tile    = np.repeat(np.arange(len(picks)), sizes)
+        local   = np.arange(np.sum(sizes)) - np.repeat(np.cumsum(sizes) - sizes, sizes)
+        charges = library['charges'][np.repeat(library['starts'][picks], sizes) + local]
+
+        # image row and column of every pixel, anything shifted off the image is dropped 
+        rows = t_shift[tile] + library['offsets'][picks,0][tile] + local // widths[tile]
+        cols = w_shift[tile] + library['offsets'][picks,1][tile] + local % widths[tile]
+        keep = (rows >= 0) & (rows < n_t) & (cols >= 0) & (cols < n_w)
+        rows, cols, charges = rows[keep], cols[keep], charges[keep]
+
+        if self.resolution is not None:
+            n_t, n_w, t_width, w_width = self.grid()
+            rows = np.minimum(np.floor((2*rows + 1) / t_width), n_t - 1).astype(np.int64)
+            cols = np.minimum(np.floor((cols + 0.5) / (960 * w_width)), n_w - 1).astype(np.int64)
+
+        return np.bincount(rows * n_w + cols, weights = charges, minlength = n_t * n_w).reshape(shape)
+
+    def nearest_tiles(self, isotope, depths):
+        """
+        Index of the library tile of the isotope built at the depth nearest each of depths (mm from the APA).
+        """
+
+        tiles = np.flatnonzero(self.library['isotopes'] == isotope)
+        tiles = tiles[np.argsort(self.library['depths'][tiles])]
+        built = self.library['depths'][tiles]
+
+        # the tile either side of each depth, keeping whichever is nearer 
+        upper = np.minimum(np.searchsorted(built, depths), len(tiles) - 1)
+        lower = np.maximum(upper - 1, 0)
+        below = np.abs(depths - built[lower]) < np.abs(built[upper] - depths)
+
+        return tiles[np.where(below, lower, upper)]
+
+    def random_stream(self, stage, key = ()):
+        """
+        Returns a numpy Generator for one stage of the simulation, independent of every other stage and seed. seed may be an int or a 
+        SeedSequence, such as the per-task ones handed out by batch_runner. key (ints) tells apart streams of the same stage.
+        """
+
+        if isinstance(self.seed, np.random.SeedSequence):
+            seq = self.seed
+        else:
+            seq = np.random.SeedSequence(self.seed)
+
+        return np.random.default_rng(np.random.SeedSequence(seq.entropy, spawn_key = seq.spawn_key + (stage,) + tuple(key)))
+
+    def digitize(self, signal):
+        """
+        Converts a binned charge image to ADC counts and applies the electronics response and thermal noise, building the float32 image 
+        in one buffer. Columns with no charge sit at the baseline, which the response leaves unchanged, so only charged columns are 
+        converted and convolved. At a coarser resolution each pixel is the mean of the full resolution pixels it covers: the charge is 
+        converted per full resolution pixel, the response narrows to the wider time bins and the noise is that of the mean of independent 
+        pixels. Only saturation differs, as it applies to the mean rather than to each full resolution pixel.
+        """
+
+        # full resolution pixels (and time bins) per output pixel 
+        area, t_scale = self.pixel_scale()
 
-        # create TPC image (histogram with number of hits on each wire for each 2 micro second time interval)
-        signal = hist(event_diffused_locs[:,0], event_diffused_locs[:,1], bins = [Yedge, Xedge], statistic = 'count', values = event_diffused_locs[:,0])[0]
-        shape = signal.shape
-       
         # convert to ADC counts 
         adc_range = [500,4091]
 
         # arbitrary max hits, anything above will  be max ADC (saturation)
         hits_range = [0, 4500] 
-        ADC = transform(hits_range, adc_range, bounds_error = False, fill_value = 4091)
-        flat_sig = signal.flatten()
-        signal = ADC(flat_sig)
-        signal = signal.reshape((shape))
-
-        # add gaussian smears in time due to electronic noise
-        signal = self.gaussian_blur(signal)
-        signal = self.gaussian_noise(signal)
-        self.result = signal
-        
-        #plot or save the TPC image 
-        self.plot_image(signal)
+
+        # thermal noise drawn straight into the image, then raised to the baseline 
+        image = np.empty(signal.shape, dtype = np.float32)
+        self.rng.standard_normal(dtype = np.float32, out = image)
+        image *= self.noise / np.sqrt(area)
+        image += adc_range[0]
+
+        charged = np.flatnonzero(np.any(signal != 0, axis = 0))
+        if len(charged) > 0:
+            # linear hits -> ADC conversion above the baseline, clipped at saturation 
+            adc = np.asarray(signal[:,charged], dtype = np.float32)
+            adc *= (adc_range[1] - adc_range[0]) / (hits_range[1] - hits_range[0]) / area
+            np.minimum(adc, adc_range[1] - adc_range[0], out = adc)
+
+            # add gaussian smears in time due to electronic noise
+            image[:,charged] += self.gaussian_blur(adc, self.blur / t_scale)
+
+        return image
 
     def plot_image(self, image):
+        """
+        Saves the image with save_image, as the output stage.
+        """
+
+        with self.stage('output'):
+            self.save_image(image)
+
+    def save_image(self, image):
+
+        # append the raw ADC image and its metadata to the dataset shards, if writing to them 
+        if self.writer is not None:
+            self.writer.append(image, **self.image_metadata())
+            return
 
         #plt.figure()
         #ax = fig.set_ylim(bottom = -500)
@@ -417,13 +812,24 @@ class simulation(radiation_package):
             os.mkdir(dir)
         except:
             pass
+        import matplotlib.pyplot as plt 
         plt.imsave('./'+dir+'/sn_{}.jpeg'.format(self.event_num),image, vmin = 450, vmax = 4091)
 
+    def image_metadata(self):
+        """
+        Parameters stored alongside each image written to a dataset shard.
+        """
+
+        return {'event': self.event_num, 'lifetime': self.lifetime, 't_coef': self.t_coef, 'd_coef': self.d_coef, 
+                'activity': self.activity, 'seed': self.seed}
+
     def plot_distributions(self, image):
         """
         Function no longer used, but potential can create a trace of the signal on each wire.
         """
 
+        import matplotlib.pyplot as plt 
+
         wire_nums = np.arange(959)
         total_sig1 = []
         total_sig2 = []
@@ -433,16 +839,245 @@ class simulation(radiation_package):
 
         plt.figure()
         plt.bar(wire_nums, total_sig1)
-        plt.title('Peak Wire Signals - mean{}'.format(self.mean))
+        plt.title('Peak Wire Signals - Event {}'.format(self.event_num))
         plt.xlabel('Wire Number')
         plt.ylabel('ADC Counts')
         plt.show()
 
         return total_sig1
         
+    def transport(self, locations, bunch_pops):
+        """
+        Drifts a whole set of edep bunches to the APA at once. Takes the (N,3) bunch locations and (N,) bunch populations and returns 
+        the drift times, APA intercepts, attenuated bunch populations and the longitudinal/transverse diffusion stds as arrays.
+        """
+
+        # drift distance and time of each bunch to the APA 
+        distance    = np.abs(self.screen - locations[:,0])
+        drift_times = distance / self.v
+
+        # bunch-screen intercepts and electron lifetime 
+        intercepts  = self.calc_intercept(locations)
+        bunch_pops  = self.electron_lifetime(bunch_pops, drift_times)
+
+        # diffusion effects 
+        std_time, std_space = self.diffusion_calcs(drift_times, distance)
+
+        return drift_times, intercepts, bunch_pops, std_time, std_space
+
+    def diffuse(self, mean_times, mean_spaces, std_times, std_spaces, bunch_pops):
+        """
+        Samples the diffused (time, position) of every drift electron of every bunch at once. The total number of electrons is found 
+        up front, so the output is allocated a single time and filled by one draw of independent time/space Gaussian offsets.
+        """
+
+        # number of electrons in each bunch (truncated to whole electrons) 
+        counts = np.asarray(bunch_pops).astype(np.int64)
+        self.num_electrons = int(counts.sum())
+
+        # |time|position| of each electron; row 0 is the (0,0) location the TPC image has always been seeded with 
+        diffused_locs = np.zeros((self.num_electrons + 1, 2))
+        diffused_locs[1:] = self.rng.standard_normal(size = (self.num_electrons, 2))
+
+        # scale and shift the offsets by the std and mean of the bunch each electron belongs to 
+        diffused_locs[1:,0] *= np.repeat(std_times, counts)
+        diffused_locs[1:,0] += np.repeat(mean_times, counts)
+        diffused_locs[1:,1] *= np.repeat(std_spaces, counts)
+        diffused_locs[1:,1] += np.repeat(mean_spaces, counts)
+
+        return diffused_locs
+
+    def bin_electrons(self, diffused_locs, space_range = None, split = None):
+        """
+        Histograms the diffused electron locations onto the TPC grid of 2 micro second time bins x wires. Wire positions are normalised 
+        0->1 over space_range, which defaults to the extent of the electrons themselves. With split, the electrons before and from row 
+        split on are histogrammed separately (on the same wires) and returned stacked.
+        """
+
+        if space_range is None:
+
+            # transform all the data points to +ve space for binning 
+            diffused_locs[:,1] = self.positive_transform(diffused_locs[:,1])
+            space_range = [min(diffused_locs[:,1]), max(diffused_locs[:,1])]
+
+        # normalise each position from 0->1, anything outside space_range falls off the grid 
+        outside = (diffused_locs[:,1] < space_range[0]) | (diffused_locs[:,1] > space_range[1])
+        diffused_locs[:,1] = (1 / (space_range[1] - space_range[0])) * (diffused_locs[:,1] - space_range[0])
+        diffused_locs[outside,1] = -1
+
+        # bin all the data according to the dimensions of the detector, or onto the coarser grid of the output resolution 
+        Xedge = np.arange(0, 1, 1/960)
+        Yedge = np.arange(-500, 500, 2)
+        if self.resolution is not None:
+            n_t, n_w, t_width, w_width = self.grid()
+            Xedge = w_width * np.arange(n_w + 1)
+            Yedge = -500 + t_width * np.arange(n_t + 1)
+
+        if split is None:
+            return np.histogram2d(diffused_locs[:,0], diffused_locs[:,1], bins = [Yedge, Xedge])[0]
+
+        return np.stack([np.histogram2d(locs[:,0], locs[:,1], bins = [Yedge, Xedge])[0] for locs in (diffused_locs[:split], diffused_locs[split:])])
+
+    def accumulate_electrons(self, mean_times, mean_spaces, std_times, std_spaces, bunch_pops, space_range, images = None, num_images = 1, 
+                             seeded = None):
+        """
+        diffuse + bin_electrons onto a fixed wire range without holding every electron at once. Electrons are drawn and histogrammed in 
+        chunks sized to keep under max_memory bytes, a bunch may be split across chunks. The draws continue the same stream in the same 
+        order whatever the chunk size, so the image matches a single pass. As in bin_electrons, the (0,0) seed location is counted.
+        Given the image each bunch belongs to, num_images images are binned at once and returned stacked, with the seed location counted 
+        in the images listed in seeded (default all).
+        """
+
+        # ~64 bytes of working arrays per electron in a chunk 
+        chunk = max(1, int(self.max_memory) // 64)
+
+        counts = np.asarray(bunch_pops).astype(np.int64)
+        ends   = np.cumsum(counts)
+        self.num_electrons = int(ends[-1]) if len(ends) > 0 else 0
+
+        # same grid as bin_electrons: time bins from -500, and fractions of space_range in wire 
+        n_t, n_w, t_width, w_width = self.grid()
+        w0, w_width = space_range[0], (space_range[1] - space_range[0]) * w_width
+
+        # the (0,0) seed location of every (seeded) image, then every electron 
+        seeded = np.arange(num_images) if seeded is None else np.asarray(seeded, dtype = np.int64)
+        signal = np.zeros(num_images * n_t * n_w)
+        self.bin_flat(signal, np.zeros(len(seeded)), np.zeros(len(seeded)), w0, w_width, seeded)
+        for start in range(0, self.num_electrons, chunk):
+            stop = min(start + chunk, self.num_electrons)
+
+            # the bunch each electron of the chunk belongs to, then its diffused time and position 
+            bunch   = np.searchsorted(ends, np.arange(start, stop), side = 'right')
+            offsets = self.rng.standard_normal(size = (stop - start, 2))
+            self.bin_flat(signal, offsets[:,0] * std_times[bunch] + mean_times[bunch], offsets[:,1] * std_spaces[bunch] + mean_spaces[bunch], 
+                          w0, w_width, None if images is None else images[bunch])
+
+        if images is None:
+            return signal.reshape((n_t, n_w))
+
+        return signal.reshape((num_images, n_t, n_w))
+
+    def bin_flat(self, signal, times, spaces, w0, w_width, images = None):
+        """
+        Adds electrons at (times, spaces) into a flattened image of the grid with wires of w_width from w0, dropping any off the grid. 
+        With the image index of each electron, signal is a stack of flattened images.
+        """
+
+        n_t, n_w, t_width = self.grid()[:3]
+        rows = np.floor((times + 500) / t_width)
+        cols = np.floor((spaces - w0) / w_width)
+        keep = (rows >= 0) & (rows < n_t) & (cols >= 0) & (cols < n_w)
+        flat = rows[keep].astype(np.int64) * n_w + cols[keep].astype(np.int64)
+        if images is not None:
+            flat += images[keep] * (n_t * n_w)
+
+        # a sparse handful of electrons is added one by one rather than counted over the whole (stack of) image(s) 
+        if len(flat) < len(signal) // 8:
+            np.add.at(signal, flat, 1)
+        else:
+            signal += np.bincount(flat, minlength = len(signal))
+
+    def expected_charge(self, mean_times, mean_spaces, std_times, std_spaces, bunch_pops, space_range = None, fluctuate = False):
+        """
+        Analytic alternative to diffuse + bin_electrons. Each bunch is an axis-aligned Gaussian, so its contribution to a (time, wire) 
+        bin is its population times a product of normal CDF differences across the bin edges, evaluated over a window of WINDOW stds 
+        around its mean. With fluctuate, every bin is Poisson fluctuated about its expected charge.
+        """
+
+        from scipy.special import ndtr
+
+        WINDOW     = 5        # half-width of the window around each bunch mean, in stds 
+        CHUNK_BINS = 2**22    # soft cap on the (bunches x window bins) block evaluated at once 
+
+        # same grid as bin_electrons: uniform edges t0 + i*t_width in time, and wire positions normalised 0->1 over space_range 
+        n_t, n_w, t_width, w_width = self.grid()
+
+        # only whole electrons are drifted, as in diffuse; a zero std is a point deposition 
+        counts = np.asarray(bunch_pops).astype(np.int64)
+        keep   = counts > 0
+        counts = counts[keep]
+        mean_times, mean_spaces = mean_times[keep], mean_spaces[keep]
+        std_times  = np.maximum(std_times[keep], 1e-9)
+        std_spaces = np.maximum(std_spaces[keep], 1e-9)
+
+        if space_range is None:
+            space_range = self.expected_range(mean_spaces, std_spaces, counts)
+        t0 = -500
+        w0, w_width = space_range[0], (space_range[1] - space_range[0]) * w_width
+
+        # first bin and number of bins of each bunch window, clipped to the grid 
+        t_start = np.clip(np.floor((mean_times - WINDOW*std_times - t0) / t_width), 0, n_t).astype(np.int64)
+        t_stop  = np.clip(np.floor((mean_times + WINDOW*std_times - t0) / t_width) + 1, 0, n_t).astype(np.int64)
+        w_start = np.clip(np.floor((mean_spaces - WINDOW*std_spaces - w0) / w_width), 0, n_w).astype(np.int64)
+        w_stop  = np.clip(np.floor((mean_spaces + WINDOW*std_spaces - w0) / w_width) + 1, 0, n_w).astype(np.int64)
+        t_n, w_n = t_stop - t_start, w_stop - w_start
+
+        # evaluate small footprints together so the padded window of each chunk stays tight 
+        order = np.argsort(t_n * w_n)
+        order = order[t_n[order] * w_n[order] > 0]
+
+        signal = np.zeros(n_t * n_w)
+        i = 0
+        while i < len(order):
+            chunk = order[i:i + max(1, CHUNK_BINS // int(t_n[order[i]] * w_n[order[i]]))]
+            i += len(chunk)
+
+            # bin indices covered by each window, padded to the largest window in the chunk 
+            t_idx = t_start[chunk,None] + np.arange(t_n[chunk].max())
+            w_idx = w_start[chunk,None] + np.arange(w_n[chunk].max())
+
+            # probability of an electron landing in each bin of the window, zero in the padding 
+            t_edges = t0 + t_width*np.concatenate((t_idx, t_idx[:,-1:] + 1), axis = 1)
+            w_edges = w0 + w_width*np.concatenate((w_idx, w_idx[:,-1:] + 1), axis = 1)
+            t_prob  = np.diff(ndtr((t_edges - mean_times[chunk,None]) / std_times[chunk,None]), axis = 1)
+            w_prob  = np.diff(ndtr((w_edges - mean_spaces[chunk,None]) / std_spaces[chunk,None]), axis = 1)
+            t_prob[t_idx >= t_stop[chunk,None]] = 0
+            w_prob[w_idx >= w_stop[chunk,None]] = 0
+
+            # add population x outer product of the time and wire probabilities into the flattened image 
+            weights = counts[chunk,None,None] * t_prob[:,:,None] * w_prob[:,None,:]
+            flat    = np.minimum(t_idx, n_t - 1)[:,:,None] * n_w + np.minimum(w_idx, n_w - 1)[:,None,:]
+            signal += np.bincount(flat.ravel(), weights = weights.ravel(), minlength = n_t * n_w)
+
+        signal = signal.reshape((n_t, n_w))
+        if fluctuate:
+            signal = self.rng.poisson(signal).astype(np.float64)
+
+        return signal
+
+    def expected_range(self, mean_spaces, std_spaces, bunch_pops):
+        """
+        Default wire range of expected_charge: the extent of the bunches holding whole electrons out to 3 stds, including the (0,0) 
+        location the sampled image is seeded with.
+        """
+
+        keep = np.asarray(bunch_pops).astype(np.int64) > 0
+        mean_spaces, std_spaces = mean_spaces[keep], np.maximum(std_spaces[keep], 1e-9)
+
+        return [min(0, np.amin(mean_spaces - 3*std_spaces, initial = 0)), max(0, np.amax(mean_spaces + 3*std_spaces, initial = 0))]
+
+    def compare_binning(self):
+        """
+        Sanity check of the analytic binning against per-electron sampling for the bunches of this image. Both are binned over the same 
+        wire range; returns the Pearson chi2/ndf over bins expecting at least 5 electrons and the relative difference in total binned 
+        charge. Each bunch is multinomial across its bins, so agreement gives a chi2/ndf at or a little below 1. Not used by default.
+        """
+
+        # sample every electron, dropping the (0,0) seed location 
+        diffused_locs = self.diffuse(*self.bunches)[1:]
+        space_range   = [np.amin(diffused_locs[:,1]), np.amax(diffused_locs[:,1])]
+
+        sampled  = self.bin_electrons(diffused_locs, space_range)
+        expected = self.expected_charge(*self.bunches, space_range = space_range)
+
+        mask = expected >= 5
+        chi2 = np.sum((sampled[mask] - expected[mask])**2 / expected[mask])
+
+        return chi2 / np.count_nonzero(mask), (np.sum(sampled) - np.sum(expected)) / np.sum(expected)
+
     def diffusion_calcs(self, drift_time, distance): 
         """
-        Function returns the standard deviation of each diffusion direction. 
+        Function returns the standard deviation of each diffusion direction. Works on single bunches or arrays of bunches. 
         """
 
         # longitudinal diffusion in time 
@@ -458,11 +1093,12 @@ class simulation(radiation_package):
         Simple attenuation function to model electron attachement to electrongeative impurities in the LAr. Decaying exponential.
         """
 
-        return bunch_pop*exp(-drift_time/self.lifetime)
+        return bunch_pop*np.exp(-drift_time/self.lifetime)
 
     def calc_intercept(self, location):
         """
-        Intercept between electron bunch and APA. Assumes shortest distance, straight line trajectory.
+        Intercept between electron bunch and APA. Assumes shortest distance, straight line trajectory. Takes a single (3,) location 
+        or an (N,3) array of locations.
         """
 
         # point on the plane: 
@@ -472,27 +1108,41 @@ class simulation(radiation_package):
         n = np.array((5,0,0))
 
         # calculate the scale factor, t, in intersept eqn: ro + d * t
-        t = (np.dot((plane_point - location), n)/(np.dot(n,n)))
-        intercept = location[0:3] + t * n
+        t = (np.dot((plane_point - location[...,0:3]), n)/(np.dot(n,n)))
+        intercept = location[...,0:3] + np.multiply.outer(t, n)
         
         return intercept
     
-    def gaussian_blur(self,image):
+    def gaussian_blur(self,image, sigma = None):
         """
-        Accounts for imperfect response of electronics in time by smearing TPC image vertically with a std of 2 time bins. 
+        Accounts for imperfect response of electronics in time by smearing TPC image vertically with a std of sigma (default self.blur) 
+        time bins. 
         """
 
-        return gaussian(image, sigma=(2,0), truncate = 10, multichannel=False)
+        kernel = self.response_kernel(self.blur if sigma is None else sigma)
+        radius = len(kernel) // 2
 
-    def gaussian_noise(self,image):
+        # correlate along time with the edge rows repeated beyond the image, one shifted slice per tap 
+        padded  = np.pad(np.asarray(image, dtype = np.float32), ((radius, radius), (0, 0)), mode = 'edge')
+        blurred = np.zeros(np.shape(image), dtype = np.float32)
+        for i in range(len(kernel)):
+            blurred += kernel[i] * padded[i:i + len(blurred)]
+
+        return blurred
+
+    def response_kernel(self, sigma, truncate = 10):
         """
-        Adds thermal electronic noise.
+        Normalised 1D gaussian time response out to truncate stds (the kernel skimage's gaussian filter used), cached per sigma.
         """
 
-        noise = np.random.normal(loc = 0.0, scale = self.noise, size = image.shape)
+        key = (sigma, truncate)
+        if key not in _response_kernels:
+            radius = int(truncate * sigma + 0.5)
+            kernel = np.exp(-0.5 * (np.arange(-radius, radius + 1) / sigma)**2)
+            _response_kernels[key] = (kernel / np.sum(kernel)).astype(np.float32)
+
+        return _response_kernels[key]
 
-        return image + noise 
-    
     def positive_transform(self,event_data):
         """
         Transforms all the bunch locations to positive space for easier handling. 
@@ -503,20 +1153,228 @@ class simulation(radiation_package):
         
         # check if negative - yes, rescale to zero
         if z_min < 0: 
-            for i in range(len(event_data)):
-                event_data[i] = event_data[i] - z_min 
+            event_data -= z_min 
                 
         return event_data
 
 
-"""
-This code stub calls the above simulation class to create TPC images for the first 2000 GEANT4 events (in electron_data.txt) for different lifetimes.
-"""
-lifetimes = [2,4,6,8,10,15,20,25,30,35,40,45,50,60,70,80,90,100,200,300] #micro seconds 
-start = time()
-for i in lifetimes:
-    for j in range(1):
-        x = simulation(j,10,i, 7.4e-4,24e-4)
-        print('COMPLETED EVENT {} for rad {}'.format(j, i))
-end = time()
-print(end-start)
\ No newline at end of file
+class background_simulation(simulation):
+    """
+    Background-only ("noise") images: radiological decays at the given activity, uniform over an explicit box ((x0,x1),(y0,y1),(z0,z1)) 
+    in mm and creation time window in micro seconds, with no neutrino event. The decays of a whole batch of images are drawn, smeared, 
+    drifted and binned together in single vectorised passes, and only the digitisation is done image by image. Wires have a fixed 
+    pitch, centred on the box in y unless origin is given, so every image has the same geometry; signal images to classify against 
+    them need the same pitch (simulate and simulate_background share DEFAULT_PARAMS['pitch']).
+    """
+
+    def __init__(self, box, screen, lifetime, t_coef, d_coef, activity = 1e-3, window = (-500, 500), binning = 'sample', seed = 3, pitch = 0.5, 
+                 origin = None, max_memory = 2**28, profiler = None, verbose = False, resolution = None):
+
+        if pitch is None:
+            raise ValueError('background_simulation needs a fixed wire pitch, it has no event to spread the wires over')
+
+        if profiler is not None:
+            self.profiler = profiler
+        self.verbose = verbose
+
+        self.set_parameters(screen, lifetime, t_coef, d_coef, activity, binning, seed, pitch, origin, max_memory, resolution)
+        self.window    = window
+        self.library   = None
+        self.event_num = -1
+
+        # the corners of the box stand in for the event, which the decays are spread over and the wires centred on 
+        self.event_data = np.zeros((2, 4), dtype = np.float32)
+        self.event_data[:,:3] = np.transpose(box)
+
+    def decay_volume(self):
+        """
+        Volume the decays are counted in: the box itself. 
+        """
+
+        return np.prod(self.event_data[1,:3] - self.event_data[0,:3])
+
+    def images(self, num_images):
+        """
+        Simulates num_images background-only images, returned stacked as a (num_images, time bins, wires) float32 array. Draws for the decays 
+        come from stream 0 of seed and those for diffusion, binning and noise from stream 1.
+        """
+
+        self.rng = self.random_stream(0)
+
+        # decays of each isotope in every image, then all of them populated (and smeared) in one go, Ar-39 first as in populate_radio_data 
+        with self.stage('radiological') as record:
+            rateAr, rateK = self.volume_rates()
+            num_Ar, num_K = self.rng.poisson(rateAr, size = num_images), self.rng.poisson(rateK, size = num_images)
+            radiodata = self.populate_radio_data(np.sum(num_Ar), np.sum(num_K), None)
+
+            # image of every decay, followed through the smearing to every edep 
+            images = np.concatenate((np.repeat(np.arange(num_images), num_Ar), np.repeat(np.arange(num_images), num_K)))
+            if self.SMEAR == True:
+                images = images[self.smeared_from]
+
+            drift_times, intercepts, bunch_pops, std_times, std_spaces = self.transport(radiodata[:,:3], radiodata[:,4])
+            mean_times, mean_spaces = drift_times + radiodata[:,3], intercepts[:,1]
+            record['electrons'] = int(np.sum(radiodata[:,4]))
+
+        self.rng = self.random_stream(1)
+        space_range = self.wire_range()
+
+        with self.stage('binning') as record:
+            if self.binning == 'sample':
+                # no event, so no (0,0) seed location either 
+                signal = self.accumulate_electrons(mean_times, mean_spaces, std_times, std_spaces, bunch_pops, space_range, images, num_images, 
+                                                   seeded = [])
+
+            elif self.binning in ('expected', 'poisson'):
+                signal = np.zeros((num_images,) + self.grid()[:2])
+                for k in range(num_images):
+                    mine = images == k
+                    signal[k] = self.expected_charge(mean_times[mine], mean_spaces[mine], std_times[mine], std_spaces[mine], bunch_pops[mine], 
+                                                     space_range = space_range, fluctuate = self.binning == 'poisson')
+
+            else:
+                raise ValueError('unknown binning mode {}'.format(self.binning))
+            record['electrons'] = int(np.sum(np.asarray(bunch_pops).astype(np.int64)))
+
+        with self.stage('digitize'):
+            output = np.empty(signal.shape, dtype = np.float32)
+            for k in range(num_images):
+                output[k] = self.digitize(signal[k])
+
+        return output
+
+    def image_metadata(self):
+        """
+        Parameters stored alongside each image written to a dataset shard, labelled as noise.
+        """
+
+        return dict(simulation.image_metadata(self), label = NOISE)
+
+    def save_images(self, images, writer = None, folder = 'noise'):
+        """
+        Appends the images to a dataset_writer.shard_writer, or saves them as noise_N.jpeg in folder, numbered on from those already there.
+        """
+
+        if writer is not None:
+            for image in images:
+                writer.append(image, **self.image_metadata())
+            return
+
+        import matplotlib.pyplot as plt 
+
+        os.makedirs(folder, exist_ok = True)
+        start = len([f for f in os.listdir(folder) if f.startswith('noise_')])
+        for k, image in enumerate(images):
+            plt.imsave(os.path.join(folder, 'noise_{}.jpeg'.format(start + k)), image, vmin = 450, vmax = 4091)
+
+
+def lifetime_sweep(event, lifetimes, screen, t_coef, d_coef, activity = 1e-3, store = None, binning = 'sample', seed = 3, save = True, writer = None, 
+                   resolution = None):
+    """
+    Creates one TPC image of an event for each electron lifetime. The event is loaded, drifted and given its radiological background 
+    once; only the attenuation and the stages after it are rerun per lifetime, with the random stream policy of simulation.lifetime_stage.
+    """
+
+    sim = simulation(event, screen, lifetimes[0], t_coef, d_coef, activity = activity, store = store, binning = binning, seed = seed, run = False, 
+                     writer = writer, resolution = resolution)
+
+    images = []
+    for lifetime in lifetimes:
+        images.append(sim.lifetime_stage(lifetime))
+        if save == True:
+            sim.plot_image(images[-1])
+
+    return images
+
+
+def activity_sweep(event, activities, screen, lifetime, t_coef, d_coef, store = None, binning = 'sample', seed = 3, pitch = 0.5, library = None, 
+                   save = True, writer = None, resolution = None):
+    """
+    Creates one TPC image of an event for each K-42 activity. The event is drifted, diffused and binned once into a signal layer, with 
+    the radiological background switched off, and only a background layer is simulated per activity and added to it before 
+    digitization. The wires need a fixed pitch (or a background library), so that every background layer lines up with the signal 
+    layer.
+    """
+
+    sim = simulation(event, screen, lifetime, t_coef, d_coef, activity = activities[0], store = store, binning = binning, seed = seed, run = False, 
+                     library = library, writer = writer, pitch = pitch, resolution = resolution, active = False)
+
+    # the signal layer alone 
+    sim.lifetime_stage(lifetime)
+    if sim.space_range is None:
+        raise ValueError('activity_sweep needs a fixed wire pitch or a background library')
+
+    images = []
+    for activity in activities:
+        images.append(sim.composite(sim.background_layer(activity), activity))
+        if save == True:
+            sim.plot_image(images[-1])
+
+    return images
+
+
+# physics parameters of the lifetime scan, the defaults of simulate and simulate_background; both put the wires on the same fixed pitch 
+# (in mm), so signal and noise-only images can't be told apart by their wire scale 
+DEFAULT_PARAMS = {'screen': 10, 'lifetime': 10, 't_coef': 7.4e-4, 'd_coef': 24e-4, 'pitch': 0.5}
+
+
+def seed_sequence(rng):
+    """
+    SeedSequence for the random streams of a simulation from an int, a SeedSequence, a numpy Generator (one draw is taken from it) or 
+    None (fresh entropy).
+    """
+
+    if isinstance(rng, np.random.SeedSequence):
+        return rng
+
+    if isinstance(rng, np.random.Generator):
+        return np.random.SeedSequence(int(rng.integers(2**63)))
+
+    return np.random.SeedSequence(rng)
+
+
+def simulate(event_edeps, params = None, rng = None):
+    """
+    Side-effect free simulation of one event: nothing is read from the event store, printed or saved. Takes the event's [x,y,z,edep] 
+    rows, a dict of parameters (screen, lifetime, t_coef, d_coef and pitch, defaulting to DEFAULT_PARAMS, plus any keyword argument of 
+    simulation such as activity, binning or library) and the seed (see seed_sequence). Returns the digitised TPC image. A pitch of 
+    None spreads the wires over the image's own electrons instead.
+    """
+
+    params = dict(DEFAULT_PARAMS, **(params or {}))
+    sim = simulation(np.asarray(event_edeps), params.pop('screen'), params.pop('lifetime'), params.pop('t_coef'), params.pop('d_coef'), 
+                     seed = seed_sequence(rng), run = False, verbose = False, **params)
+
+    return sim.lifetime_stage(sim.lifetime)
+
+
+def simulate_batch(events, params = None, rng = None):
+    """
+    simulate for a list of events, with one dict of parameters for all of them or a list of one per event. Each event gets its own 
+    stream spawned from the seed. Returns the images stacked into one array.
+    """
+
+    if params is None or isinstance(params, dict):
+        params = [params] * len(events)
+    seeds = seed_sequence(rng).spawn(len(events))
+
+    return np.stack([simulate(edeps, p, seed) for edeps, p, seed in zip(events, params, seeds)])
+
+
+def simulate_background(num_images, box, params = None, rng = None, window = (-500, 500)):
+    """
+    Side-effect free batch of background-only images (see background_simulation) in the given box and time window. params are as for 
+    simulate (activity sets the K-42 rate), and the images are returned as one (num_images, time bins, wires) array.
+    """
+
+    params = dict(DEFAULT_PARAMS, **(params or {}))
+    sim = background_simulation(box, params.pop('screen'), params.pop('lifetime'), params.pop('t_coef'), params.pop('d_coef'), window = window, 
+                                seed = seed_sequence(rng), **params)
+
+    return sim.images(num_images)
+
+if __name__ == '__main__':
+
+    # the lifetime sweep command line lives in sweep.py 
+    from sweep import main
+    main()
@@ -0,0 +1,121 @@
+"""
+Library of precomputed radiological background tiles. Each tile is the binned charge map of a single Ar-39 or K-42 decay, drifted
+from a random depth with one electron lifetime and diffusion setting and cropped to where it has charge. A simulation given the
+library (simulation(..., library = path)) overlays randomly shifted tiles in place of drifting and diffusing every background
+electron, with the number of decays still drawn from event_volume_rate at the simulation's own activity, and each decay given the
+tile built nearest a depth drawn over the event volume as in populate_radio_data.
+"""
+
+import numpy as np
+from LArTPC_simulation import simulation
+
+
+class tile_builder(simulation):
+    """
+    Simulation without a neutrino event, used to drift and bin single radioactive decays onto the TPC grid at a fixed wire pitch.
+    """
+
+    def __init__(self, lifetime, t_coef, d_coef, pitch, binning = 'sample', seed = 0):
+
+        # APA at x = 0, so a decay at x = -depth drifts depth mm
+        self.set_parameters(0, lifetime, t_coef, d_coef, binning = binning, seed = seed)
+        self.library = None
+        self.pitch   = pitch
+        self.rng     = self.random_stream(0)
+
+    def tile(self, isotope, depth):
+        """
+        Bins one decay created at the start of the time window and y = 0, depth mm from the APA, so that it reaches the grid from any
+        depth it could drift from within the window. Returns its charge cropped to the bins it reaches and the (time bin, wire) offset of
+        the crop from the bin holding the decay itself.
+        """
+
+        if isotope == self.K42:
+            q_value = 3.5
+        else:
+            q_value = 0.6
+
+        # |X|Y|Z|T|E|distance|isotope| of the decay
+        radiodata = np.zeros((1,7), dtype = np.float32)
+        radiodata[0,0] = self.screen - depth
+        radiodata[0,3] = self.window[0]
+        radiodata[0,4] = abs(self.beta_spect(q_value, 1)[0])
+        radiodata[0,6] = isotope
+
+        if self.SMEAR == True:
+            radiodata = self.smear_master(radiodata, 1)
+        else:
+            radiodata[:,4] = radiodata[:,4] / self.ie
+
+        # drift and bin onto a grid of the library pitch with y = 0 on wire 480
+        drift_times, intercepts, bunch_pops, std_times, std_spaces = self.transport(radiodata[:,:3], radiodata[:,4])
+        bunches     = (drift_times + radiodata[:,3], intercepts[:,1], std_times, std_spaces, bunch_pops)
+        space_range = [-480*self.pitch, 480*self.pitch]
+
+        if self.binning == 'sample':
+            signal = self.bin_electrons(self.diffuse(*bunches)[1:], space_range)
+        else:
+            signal = self.expected_charge(*bunches, space_range = space_range, fluctuate = self.binning == 'poisson')
+
+        # a decay whose electrons are all lost to attachment leaves an empty tile
+        rows, cols = np.nonzero(signal)
+        if len(rows) == 0:
+            return np.zeros((0,0)), (0, 0)
+
+        crop = signal[rows.min():rows.max()+1, cols.min():cols.max()+1]
+
+        t_bin = int(np.floor((self.window[0] + 500) / 2))
+
+        return crop, (rows.min() - t_bin, cols.min() - 480)
+
+
+def build_library(path, num_tiles, lifetime, t_coef, d_coef, depth_range = None, pitch = 0.5, binning = 'sample', seed = 0, smear = True):
+    """
+    Builds num_tiles tiles per isotope, at depths uniform over depth_range (mm from the APA), and saves them to the .npz file at path
+    with the depth of every tile. depth_range defaults to every depth a decay can drift from and still arrive within the time window
+    of the simulation. Tiles do not depend on activity, which only sets how many are overlaid.
+    """
+
+    builder = tile_builder(lifetime, t_coef, d_coef, pitch, binning, seed)
+    builder.SMEAR = smear
+
+    if depth_range is None:
+        depth_range = (0, builder.v * (builder.window[1] - builder.window[0]))
+
+    charges, shapes, offsets, isotopes, depths = [], [], [], [], []
+    for isotope in (builder.AR39, builder.K42):
+        for depth in builder.rng.uniform(depth_range[0], depth_range[1], size = num_tiles):
+            crop, offset = builder.tile(isotope, depth)
+            charges.append(crop.ravel())
+            shapes.append(crop.shape)
+            offsets.append(offset)
+            isotopes.append(isotope)
+            depths.append(depth)
+
+    # tiles are stored back to back in one flat array, tile i starting at starts[i]
+    sizes  = np.array([len(c) for c in charges], dtype = np.int64)
+    starts = np.cumsum(sizes) - sizes
+
+    np.savez_compressed(path, charges = np.concatenate(charges).astype(np.float32), shapes = np.array(shapes, dtype = np.int64),
+                        offsets = np.array(offsets, dtype = np.int64), starts = starts, isotopes = np.array(isotopes),
+                        depths = np.array(depths), lifetime = lifetime, t_coef = t_coef, d_coef = d_coef, pitch = pitch, depth_range = depth_range)
+
+    return load_library(path)
+
+
+def load_library(path):
+    """
+    Loads a background library saved by build_library into a dict of arrays.
+    """
+
+    if not path.endswith('.npz'):
+        path = path + '.npz'
+
+    with np.load(path) as library:
+        return {name: library[name] for name in library.files}
+
+
+if __name__ == '__main__':
+
+    # tiles for the default lifetime scan settings of LArTPC_simulation.py at a lifetime of 10 micro seconds
+    build_library('background_lt10', 1000, 10, 7.4e-4, 24e-4)
@@ -0,0 +1,143 @@
+"""
+Runs the simulation over a grid of events x physics parameters on a pool of worker processes. Every task gets its own random
+stream, derived from a root seed and the task's parameters, so results are reproducible and independent of how the tasks are
+scheduled across workers. Images are written in task order as they complete, and tasks that raise are retried.
+"""
+
+import os
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from itertools import product
+from time import time
+import numpy as np
+from event_store import open_event_store
+from dataset_writer import shard_writer
+from LArTPC_simulation import simulation
+
+# one simulation: event ID, electron lifetime, diffusion coefficients, APA position and K-42 activity
+task = namedtuple('task', ['event', 'lifetime', 't_coef', 'd_coef', 'screen', 'activity'])
+
+
+def make_tasks(events, lifetimes, t_coefs, d_coefs, screens, activities):
+    """
+    Returns the full grid of tasks over every combination of the given parameter values.
+    """
+
+    return [task(*values) for values in product(events, lifetimes, t_coefs, d_coefs, screens, activities)]
+
+
+def task_seed(root_seed, key):
+    """
+    SeedSequence of a task, derived from the root seed and the exact bits of the task parameters (not its position in the grid).
+    """
+
+    key_words = np.frombuffer(np.array(key, dtype = np.float64).tobytes(), dtype = np.uint32)
+
+    return np.random.SeedSequence(root_seed, spawn_key = tuple(int(w) for w in key_words))
+
+
+def save_jpeg(key, image, folder):
+    """
+    Saves the image as a JPEG in the same way as simulation.plot_image, named by its task parameters. Pass as write to run_batch to get 
+    the old per-image output instead of dataset shards.
+    """
+
+    import matplotlib.pyplot as plt
+
+    name = 'sn_{}_lt{}_t{}_d{}_s{}_a{}.jpeg'.format(*key)
+    plt.imsave(os.path.join(folder, name), image, vmin = 450, vmax = 4091)
+
+
+# event store of each worker process, opened once by _init_worker
+_store = None
+
+def _init_worker(store_path):
+    global _store
+    _store = open_event_store(store_path)
+
+def _run_task(key, root_seed, binning):
+    sim = simulation(key.event, key.screen, key.lifetime, key.t_coef, key.d_coef, activity = key.activity, store = _store,
+                     binning = binning, seed = task_seed(root_seed, key), run = False, verbose = False)
+
+    return sim.lifetime_stage(key.lifetime)
+
+
+def run_batch(tasks, root_seed = 0, processes = None, folder = 'batch_output', retries = 2, binning = 'sample',
+              store_path = 'event_store', write = None):
+    """
+    Simulates every task on a pool of processes (default: one per core) and writes the images in task order, by default to dataset 
+    shards in folder, or by calling write(key, image, folder). A task that raises is resubmitted up to retries times. A worker that 
+    dies (e.g. killed for running out of memory) breaks the whole pool, so the pool is then rebuilt and every unfinished task 
+    resubmitted, with the attempt counted against the task being waited on. Returns the tasks that still failed.
+    """
+
+    tasks = list(tasks)
+    os.makedirs(folder, exist_ok = True)
+
+    writer = None
+    if write is None:
+        writer = shard_writer(folder)
+        write  = lambda key, image, folder: writer.append(image, event = key.event, lifetime = key.lifetime, t_coef = key.t_coef, 
+                                                          d_coef = key.d_coef, activity = key.activity, seed = task_seed(root_seed, key))
+
+    # make sure the event store exists before the workers open it
+    open_event_store(store_path)
+
+    def new_pool():
+        return ProcessPoolExecutor(max_workers = processes, initializer = _init_worker, initargs = (store_path,))
+
+    failed = []
+    start  = time()
+    pool   = new_pool()
+    try:
+        futures = [pool.submit(_run_task, key, root_seed, binning) for key in tasks]
+
+        for i, key in enumerate(tasks):
+            image = None
+            for attempt in range(retries + 1):
+                try:
+                    image = futures[i].result()
+                    break
+                except BrokenProcessPool as error:
+                    print('FAILED {} (attempt {}/{}), a worker died: {}'.format(key, attempt + 1, retries + 1, error))
+
+                    # every task still pending in the broken pool is lost, so resubmit all those that didn't finish to a new one 
+                    pool.shutdown(wait = False)
+                    pool = new_pool()
+                    for j in range(i + 1, len(tasks)):
+                        if not futures[j].done() or futures[j].exception() is not None:
+                            futures[j] = pool.submit(_run_task, tasks[j], root_seed, binning)
+                    if attempt < retries:
+                        futures[i] = pool.submit(_run_task, key, root_seed, binning)
+                except Exception as error:
+                    print('FAILED {} (attempt {}/{}): {}'.format(key, attempt + 1, retries + 1, error))
+                    if attempt < retries:
+                        futures[i] = pool.submit(_run_task, key, root_seed, binning)
+
+            # drop the finished future so its image can be freed
+            futures[i] = None
+
+            if image is None:
+                failed.append(key)
+            else:
+                write(key, image, folder)
+
+            elapsed = time() - start
+            print('COMPLETED {}/{} {}\nTime: {:.1f}s, ETA: {:.1f}s'.format(i + 1, len(tasks), key, elapsed, elapsed / (i + 1) * (len(tasks) - i - 1)))
+    finally:
+        pool.shutdown()
+
+    if writer is not None:
+        writer.close()
+
+    return failed
+
+
+if __name__ == '__main__':
+
+    # the lifetime scan of LArTPC_simulation.py, spread over every core
+    lifetimes = [2,4,6,8,10,15,20,25,30,35,40,45,50,60,70,80,90,100,200,300] #micro seconds
+    tasks = make_tasks(range(1), lifetimes, [7.4e-4], [24e-4], [10], [1e-3])
+    failed = run_batch(tasks, root_seed = 3)
+    print('FAILED TASKS:', failed)
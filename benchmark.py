@@ -0,0 +1,155 @@
+"""
+Reproducible benchmark of the simulation stages. Events are generated synthetically in the electron_data.npy format (curving
+electron tracks of a set number of edeps), so no GEANT4 file is needed, and every case is simulated with a fixed seed so repeated
+runs do the same work. Each case is run a few times under a profiling.stage_profiler and the fastest time of each stage is kept.
+Results are saved as JSON, and can be compared against an earlier results file to flag regressions:
+
+    python benchmark.py --out new.json --baseline old.json
+"""
+
+import os
+import json
+import argparse
+import tempfile
+from collections import namedtuple
+import numpy as np
+from event_store import convert_electron_data
+from dataset_writer import shard_writer
+from profiling import stage_profiler
+from LArTPC_simulation import simulation
+
+# one benchmark setting: edeps per event, K-42 activity per module per micro second and binning mode
+case = namedtuple('case', ['edeps', 'activity', 'binning'])
+
+
+def synthetic_electron_data(num_events, edeps_per_event, energy = 20, seed = 0):
+    """
+    Rows of [x,y,z,edep,0,event ID] like electron_data.npy: each event is a smoothly curving track of edeps_per_event steps carrying
+    about energy MeV in total (roughly 4.7 mm per MeV, as for an electron in liquid argon), ending at x = 0.
+    """
+
+    rng  = np.random.default_rng(seed)
+    rows = np.zeros((num_events * edeps_per_event, 6))
+
+    for event in range(num_events):
+        # a random initial direction that wanders a little every step
+        directions = rng.standard_normal(3) + np.cumsum(0.05 * rng.standard_normal((edeps_per_event, 3)), axis = 0)
+        directions /= np.linalg.norm(directions, axis = 1)[:,None]
+
+        steps  = directions * 4.7 * energy / edeps_per_event
+        track  = np.cumsum(steps, axis = 0)
+        track[:,0] -= np.amax(track[:,0])
+        edeps  = rng.gamma(4, 0.25, size = edeps_per_event) * energy / edeps_per_event
+
+        block = rows[event * edeps_per_event:(event + 1) * edeps_per_event]
+        block[:,:3] = track
+        block[:,3]  = edeps
+        block[:,5]  = event
+
+    return rows
+
+
+def synthetic_store(folder, num_events, edeps_per_event, seed = 0):
+    """
+    Writes synthetic electron data into folder and converts it to an event store there.
+    """
+
+    os.makedirs(folder, exist_ok = True)
+    source = os.path.join(folder, 'electron_data.npy')
+    np.save(source, synthetic_electron_data(num_events, edeps_per_event, seed = seed))
+
+    return convert_electron_data(source, os.path.join(folder, 'event_store'))
+
+
+def run_case(setting, store, repeats, memory = True, seed = 0):
+    """
+    Simulates every event of the store repeats times with the profiler, writing the images to a scratch shard folder. Returns one
+    record per stage: the fastest total over the repeats of its wall time, and its electrons and peak memory.
+    """
+
+    best = {}
+    with tempfile.TemporaryDirectory() as folder:
+        for repeat in range(repeats):
+            profiler = stage_profiler(memory)
+            with shard_writer(folder, shard_size = 1) as writer:
+                for event in store.event_ids:
+                    simulation(int(event), 10, 10, 7.4e-4, 24e-4, activity = setting.activity, store = store, binning = setting.binning,
+                               seed = seed, writer = writer, profiler = profiler)
+
+            summary = profiler.summary()
+            total = {'stage': 'total', 'calls': 1, 'wall': sum(r['wall'] for r in profiler.records if r['stage'] != 'smearing'),
+                     'electrons': 0, 'peak_memory': max(r['peak_memory'] or 0 for r in profiler.records)}
+            for record in summary + [total]:
+                if record['stage'] not in best or record['wall'] < best[record['stage']]['wall']:
+                    best[record['stage']] = record
+
+    return [dict(record, **setting._asdict()) for record in best.values()]
+
+
+def compare(results, baseline, tolerance = 0.2, min_wall = 0.005):
+    """
+    Matches results to a baseline by (case, stage) and prints the time ratio of each. Returns the records that got more than tolerance
+    slower; stages faster than min_wall seconds in the baseline are too noisy to judge and are skipped.
+    """
+
+    key  = lambda r: (r['edeps'], r['activity'], r['binning'], r['stage'])
+    old  = {key(r): r for r in baseline}
+    slow = []
+
+    print('{:<36}{:>12}{:>12}{:>9}'.format('case / stage', 'old (s)', 'new (s)', 'ratio'))
+    for record in results:
+        if key(record) not in old:
+            continue
+
+        before = old[key(record)]['wall']
+        ratio  = record['wall'] / before if before > 0 else np.inf
+        flag   = ''
+        if before >= min_wall and ratio > 1 + tolerance:
+            slow.append(record)
+            flag = '  SLOWER'
+        print('{:<36}{:>12.4f}{:>12.4f}{:>9.2f}{}'.format('{}/{}/{} {}'.format(*key(record)), before, record['wall'], ratio, flag))
+
+    return slow
+
+
+def main(argv = None):
+
+    parser = argparse.ArgumentParser(description = 'Benchmark the simulation stages on synthetic events.')
+    parser.add_argument('--edeps', type = int, nargs = '+', default = [500, 5000], help = 'edeps per synthetic event')
+    parser.add_argument('--activities', type = float, nargs = '+', default = [1e-3, 1], help = 'K-42 activities')
+    parser.add_argument('--binnings', nargs = '+', default = ['sample', 'expected'], help = 'binning modes')
+    parser.add_argument('--events', type = int, default = 2, help = 'synthetic events per case')
+    parser.add_argument('--repeats', type = int, default = 3, help = 'runs per case, the fastest is kept')
+    parser.add_argument('--seed', type = int, default = 0)
+    parser.add_argument('--no-memory', action = 'store_true', help = 'only time the stages, without tracing memory')
+    parser.add_argument('--out', default = 'benchmark_results.json')
+    parser.add_argument('--baseline', default = None, help = 'earlier results to compare against')
+    parser.add_argument('--tolerance', type = float, default = 0.2, help = 'fractional slowdown counted as a regression')
+    args = parser.parse_args(argv)
+
+    results = []
+    with tempfile.TemporaryDirectory() as folder:
+        for edeps in args.edeps:
+            store = synthetic_store(os.path.join(folder, str(edeps)), args.events, edeps, args.seed)
+            for activity in args.activities:
+                for binning in args.binnings:
+                    setting = case(edeps, activity, binning)
+                    records = run_case(setting, store, args.repeats, not args.no_memory, args.seed)
+                    results += records
+                    print('COMPLETED {}: {:.3f}s'.format(setting, [r for r in records if r['stage'] == 'total'][0]['wall']))
+
+    with open(args.out, 'w') as f:
+        json.dump(results, f, indent = 1)
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            slow = compare(results, json.load(f), args.tolerance)
+        if len(slow) > 0:
+            print('{} stages slower than the baseline'.format(len(slow)))
+            return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
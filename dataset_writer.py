@@ -0,0 +1,112 @@
+"""
+Sharded binary storage for simulated TPC images. Raw ADC arrays are buffered in memory and written a shard at a time as compressed
+.npz files, each image alongside its metadata (event ID, lifetime, diffusion coefficients, activity, seed and label), so a dataset
+is a handful of large files rather than one lossy JPEG per image.
+"""
+
+import os
+import numpy as np
+
+# label of an image, as the class index used by run_cnn (noise = [1,0], sn = [0,1])
+NOISE, SN = 0, 1
+
+# metadata stored with every image
+FIELDS = ['event', 'lifetime', 't_coef', 'd_coef', 'activity', 'seed', 'label']
+
+
+def seed_string(seed):
+    """
+    Text form of an int seed or a SeedSequence (entropy/spawn key), enough to recreate the random streams of an image.
+    """
+
+    if isinstance(seed, np.random.SeedSequence):
+        return '{}/{}'.format(seed.entropy, ','.join(str(k) for k in seed.spawn_key))
+
+    return str(seed)
+
+
+class shard_writer(object):
+    """
+    Appends images to a buffer and writes it out as shard_XXXXX.npz in folder every shard_size images. Use as a context manager,
+    or call close, so the last partial shard is written.
+    """
+
+    def __init__(self, folder, shard_size = 256, compress = True):
+
+        self.folder     = folder
+        self.shard_size = shard_size
+        self.compress   = compress
+        self.images     = []
+        self.metadata   = {field: [] for field in FIELDS}
+
+        # carry on after any shards already in the folder
+        os.makedirs(folder, exist_ok = True)
+        self.shard_num = len(shard_names(folder))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def append(self, image, event = -1, lifetime = np.nan, t_coef = np.nan, d_coef = np.nan, activity = np.nan, seed = '', label = SN):
+        self.images.append(np.asarray(image, dtype = np.float32))
+        self.metadata['event'].append(event)
+        self.metadata['lifetime'].append(lifetime)
+        self.metadata['t_coef'].append(t_coef)
+        self.metadata['d_coef'].append(d_coef)
+        self.metadata['activity'].append(activity)
+        self.metadata['seed'].append(seed_string(seed))
+        self.metadata['label'].append(label)
+
+        if len(self.images) >= self.shard_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Writes the buffered images as the next shard.
+        """
+
+        if len(self.images) == 0:
+            return
+
+        save = np.savez_compressed if self.compress else np.savez
+        path = os.path.join(self.folder, 'shard_{:05d}.npz'.format(self.shard_num))
+        save(path, images = np.stack(self.images), **{field: np.array(values) for field, values in self.metadata.items()})
+
+        self.shard_num += 1
+        self.images = []
+        self.metadata = {field: [] for field in FIELDS}
+
+    def close(self):
+        self.flush()
+
+
+def shard_names(folder):
+    """
+    Paths of the shards in folder, in the order they were written.
+    """
+
+    return sorted(os.path.join(folder, f) for f in os.listdir(folder) if f.startswith('shard_') and f.endswith('.npz'))
+
+
+def iter_shards(folder):
+    """
+    Yields each shard in folder as a dict of its images and metadata arrays, one shard in memory at a time.
+    """
+
+    for path in shard_names(folder):
+        with np.load(path) as shard:
+            yield {name: shard[name] for name in shard.files}
+
+
+def load_shards(folder):
+    """
+    Loads every shard in folder, returning (images, metadata) with the metadata as a dict of arrays.
+    """
+
+    shards = list(iter_shards(folder))
+    images = np.concatenate([shard['images'] for shard in shards])
+    metadata = {field: np.concatenate([shard[field] for shard in shards]) for field in FIELDS}
+
+    return images, metadata
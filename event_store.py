@@ -0,0 +1,80 @@
+"""
+Indexed, memory-mapped store for the GEANT4 neutrino event data. The raw electron_data.npy file is converted once into
+a directory holding the edeps sorted by event ID plus an offsets index, so the edeps of any event can be fetched as a
+zero-copy slice of the memory-mapped array instead of loading and scanning the whole file for every simulation.
+"""
+
+import os
+import numpy as np
+
+
+def convert_electron_data(source = 'electron_data.npy', dest = 'event_store'):
+    """
+    Converts electron_data.npy (rows of [x,y,z,edep,...,event ID]) into an event store directory at dest.
+    """
+
+    # memory-map the raw GEANT4 output so the conversion does not need two copies of the file in memory
+    electron_data = np.load(source, mmap_mode = 'r')
+    event_col     = np.asarray(electron_data[:,5])
+
+    # stable sort keeps the GEANT4 edep order within each event
+    order     = np.argsort(event_col, kind = 'stable')
+    sorted_id = event_col[order]
+
+    # |X|Y|Z|edep| rows grouped by event, and the [start, stop) offsets of each event
+    edeps = np.asarray(electron_data[order, :4])
+    event_ids, starts = np.unique(sorted_id, return_index = True)
+    offsets = np.append(starts, len(sorted_id)).astype(np.int64)
+
+    os.makedirs(dest, exist_ok = True)
+    np.save(os.path.join(dest, 'edeps.npy'), edeps)
+    np.save(os.path.join(dest, 'event_ids.npy'), event_ids)
+    np.save(os.path.join(dest, 'offsets.npy'), offsets)
+
+    return event_store(dest)
+
+
+def open_event_store(path = 'event_store', source = 'electron_data.npy'):
+    """
+    Opens the event store at path, converting it from the raw GEANT4 file on first use.
+    """
+
+    if not os.path.isfile(os.path.join(path, 'offsets.npy')):
+        return convert_electron_data(source, path)
+
+    return event_store(path)
+
+
+class event_store(object):
+    """
+    Read-only view of a converted event store. The edeps are memory-mapped, so opening the store is cheap and only the
+    pages belonging to the requested events are ever read from disk.
+    """
+
+    def __init__(self, path = 'event_store'):
+
+        self.path      = path
+        self.edeps     = np.load(os.path.join(path, 'edeps.npy'), mmap_mode = 'r')
+        self.event_ids = np.load(os.path.join(path, 'event_ids.npy'))
+        self.offsets   = np.load(os.path.join(path, 'offsets.npy'))
+
+        # event ID -> position in the offsets index
+        self.index = {int(e): i for i, e in enumerate(self.event_ids)}
+
+    def __len__(self):
+        return len(self.event_ids)
+
+    def __contains__(self, event):
+        return int(event) in self.index
+
+    def get_event(self, event):
+        """
+        Returns the [x,y,z,edep] rows of a single event as a zero-copy slice of the memory-mapped edeps.
+        """
+
+        try:
+            i = self.index[int(event)]
+        except KeyError:
+            raise KeyError('event {} is not in the event store at {}'.format(event, self.path))
+
+        return self.edeps[self.offsets[i]:self.offsets[i+1]]
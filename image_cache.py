@@ -0,0 +1,127 @@
+"""
+One-time cache of a folder of JPEG TPC images at the CNN input size. The JPEGs are decoded, converted to greyscale and resized once,
+exactly as run_cnn.load_images does, and packed into a single uint8 images.npy with a meta.json sidecar holding each image's file
+name, label and maximum pixel. The cache is keyed on the names, sizes and modification times of the JPEGs and on the image size, so
+it is rebuilt whenever the folder changes. Later loads memory-map the packed file, so they take milliseconds and the pixels are only
+read, and converted to float, a batch at a time.
+"""
+
+import os
+import json
+import shutil
+import hashlib
+import numpy as np
+from PIL import Image
+
+
+def cache_key(folder, image_size):
+    """
+    Hash of the JPEGs in folder (names, sizes and modification times) and the image size.
+    """
+
+    entries = []
+    for fname in sorted(f for f in os.listdir(folder) if f.endswith('.jpeg')):
+        stat = os.stat(os.path.join(folder, fname))
+        entries.append([fname, stat.st_size, stat.st_mtime_ns])
+
+    return hashlib.sha1(json.dumps([list(image_size), entries]).encode()).hexdigest()[:16]
+
+
+def build_image_cache(folder, image_size, dest):
+    """
+    Decodes every JPEG in folder into a packed image cache at dest. It is written to a temporary folder and renamed, so a cache is
+    never left half written.
+    """
+
+    fnames = sorted(f for f in os.listdir(folder) if f.endswith('.jpeg'))
+    tmp = dest + '.tmp'
+    shutil.rmtree(tmp, ignore_errors = True)
+    os.makedirs(tmp)
+
+    # written straight into the memory-mapped file, so only one decoded image is held at a time
+    images = np.lib.format.open_memmap(os.path.join(tmp, 'images.npy'), mode = 'w+', dtype = np.uint8,
+                                       shape = (len(fnames), image_size[0], image_size[1]))
+    for i, fname in enumerate(fnames):
+        images[i] = np.array(Image.open(os.path.join(folder, fname)).convert('L').resize((image_size[1], image_size[0])))
+    maxima = np.amax(images, axis = (1, 2)).tolist() if len(fnames) > 0 else []
+    images.flush()
+    del images
+
+    # label of each image as the class index run_cnn uses, noise = 0 and sn = 1
+    with open(os.path.join(tmp, 'meta.json'), 'w') as f:
+        json.dump({'folder': folder, 'image_size': list(image_size), 'fnames': fnames, 'labels': [1 if 'sn' in f else 0 for f in fnames],
+                   'maxima': maxima}, f)
+
+    shutil.rmtree(dest, ignore_errors = True)
+    os.replace(tmp, dest)
+
+    return image_cache(dest)
+
+
+def open_image_cache(folder, image_size = (100,100), cache_dir = None):
+    """
+    Opens the image cache of folder at image_size, building it on first use or when the JPEGs have changed. Caches are kept in
+    cache_dir, by default a .image_cache folder inside folder; caches of older contents of the folder are removed.
+    """
+
+    if cache_dir is None:
+        cache_dir = os.path.join(folder, '.image_cache')
+
+    key  = cache_key(folder, image_size)
+    path = os.path.join(cache_dir, '{}_{}x{}'.format(key, image_size[0], image_size[1]))
+    if os.path.isfile(os.path.join(path, 'meta.json')):
+        return image_cache(path)
+
+    # a changed folder invalidates its caches at this image size
+    if os.path.isdir(cache_dir):
+        for name in os.listdir(cache_dir):
+            if name.endswith('_{}x{}'.format(image_size[0], image_size[1])):
+                shutil.rmtree(os.path.join(cache_dir, name))
+
+    return build_image_cache(folder, image_size, path)
+
+
+class image_cache(object):
+    """
+    Read-only view of a packed image cache: the uint8 (N, rows, columns) images memory-mapped, and the file names, class labels and
+    per-image maximum pixels from the sidecar.
+    """
+
+    def __init__(self, path):
+
+        self.path   = path
+        self.images = np.load(os.path.join(path, 'images.npy'), mmap_mode = 'r')
+
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        self.image_size = tuple(meta['image_size'])
+        self.fnames = meta['fnames']
+        self.labels = np.array(meta['labels'], dtype = np.int64)
+        self.maxima = np.array(meta['maxima'], dtype = np.uint8)
+
+    def __len__(self):
+        return len(self.fnames)
+
+
+class packed_images(object):
+    """
+    Stand-in for the float32 (N, rows, columns, 1) array of load_images over the rows order of uint8 images (such as an image_cache's
+    memory-mapped ones), divided by scale. Indexing converts just the rows asked for, so the images never exist as float32 all at once.
+    """
+
+    def __init__(self, images, scale, order = None):
+
+        self.images = images
+        self.scale  = np.float32(scale)
+        self.order  = np.arange(len(images)) if order is None else np.asarray(order)
+        self.shape  = (len(self.order), images.shape[1], images.shape[2], 1)
+        self.dtype  = np.dtype(np.float32)
+
+    def __len__(self):
+        return len(self.order)
+
+    def __getitem__(self, rows):
+        batch = np.asarray(self.images[self.order[rows]], dtype = np.float32)
+        batch /= self.scale
+
+        return batch[..., None]
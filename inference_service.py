@@ -0,0 +1,357 @@
+"""
+Scores unlabelled TPC images with a trained CNN (see run_cnn.main(..., model_path = ...) and model_utils.load_model). Requests are
+queued to a dynamic batcher, which groups them into batches of up to max_batch images, waiting no longer than max_latency seconds
+after the oldest request, and returns the class probabilities [p(noise), p(sn)] of each image. Images can come from a file, a folder
+(JPEGs, .npy files or dataset shards), a local socket or a multiprocessing queue, and are resized and scaled with the preprocessing
+the model was saved with, as its training images were. The batcher reports throughput and latency percentiles. Score a folder, or listen on a port for clients using score_remote:
+
+    python inference_service.py trained_model --images lifetime_scan --out scores.csv
+    python inference_service.py trained_model --port 6000
+"""
+
+import os
+import csv
+import queue
+import argparse
+import threading
+from time import perf_counter
+from concurrent.futures import Future
+from multiprocessing.connection import Listener, Client
+import numpy as np
+from PIL import Image
+from dataset_writer import shard_names
+
+AUTHKEY = b'lartpc' # shared by serve_socket and score_remote
+
+
+def resize(image, image_size, method):
+    """
+    Resizes a greyscale (uint8) or raw ADC (float) image to image_size (rows, columns) with PIL's bicubic filter ('pil') or
+    tf.image's antialiased bicubic one ('tf').
+    """
+
+    if method == 'tf':
+        import tensorflow as tf
+        image = tf.image.resize(np.asarray(image, dtype = np.float32)[..., None], image_size, method = 'bicubic', antialias = True)
+        return image.numpy()[..., 0]
+
+    if image.dtype != np.uint8:
+        image = np.asarray(image, dtype = np.float32)
+
+    return np.asarray(Image.fromarray(image).resize((image_size[1], image_size[0]), Image.BICUBIC), dtype = np.float32)
+
+
+def scale_input(image, image_size, preprocessing):
+    """
+    CNN input of a greyscale or raw ADC image, resized and scaled by the preprocessing a model was saved with.
+    """
+
+    image = (resize(image, image_size, preprocessing['resize']) - preprocessing['offset']) / preprocessing['scale']
+    if preprocessing['clip']:
+        image = np.clip(image, 0, 1)
+
+    return image.astype(np.float32)[..., None]
+
+
+def render_jpeg(image):
+    """
+    Greyscale pixels of the JPEG the simulation saves of a raw ADC image (plt.imsave between 450 and 4091 ADC with the default colour
+    map), less the compression.
+    """
+
+    import matplotlib.pyplot as plt
+
+    rgba = plt.get_cmap()(np.clip((np.asarray(image, dtype = np.float32) - 450) / (4091 - 450), 0, 1), bytes = True)
+
+    return np.array(Image.fromarray(rgba[..., :3]).convert('L'))
+
+
+def cnn_input(image, image_size, preprocessing):
+    """
+    CNN input of one image: a (rows, columns) array is a raw ADC image, prepared with the model's preprocessing (and first rendered
+    as the simulation's JPEGs are, for a model trained on JPEGs), and a (rows, columns, 1) array is taken as already prepared.
+    """
+
+    image = np.asarray(image)
+    if image.ndim == 3:
+        return image.astype(np.float32)
+
+    if preprocessing is None:
+        raise ValueError('the model was saved without its preprocessing, so it can only score prepared (rows, columns, 1) images')
+
+    if preprocessing['input'] == 'jpeg':
+        image = render_jpeg(image)
+
+    return scale_input(image, image_size, preprocessing)
+
+
+def load_jpeg(path, image_size, preprocessing):
+    """
+    CNN input of a JPEG, greyscale and prepared with the model's preprocessing.
+    """
+
+    if preprocessing is None or preprocessing['input'] != 'jpeg':
+        raise ValueError('the model was not trained on JPEGs, so it can not score {}'.format(path))
+
+    if preprocessing['resize'] == 'tf':
+        # decoded straight to greyscale, as run_cnn.image_stream does
+        import tensorflow as tf
+        image = tf.io.decode_jpeg(tf.io.read_file(path), channels = 1).numpy()[..., 0]
+    else:
+        image = np.array(Image.open(path).convert('L'))
+
+    return scale_input(image, image_size, preprocessing)
+
+
+def image_files(path, image_size, preprocessing):
+    """
+    Yields (name, CNN input) for every image in path: a JPEG, an .npy file of one or a stack of raw ADC images, a dataset shard, or a
+    folder of any of these (shards only, if it holds any), prepared with the model's preprocessing.
+    """
+
+    if os.path.isdir(path):
+        shards = shard_names(path)
+        if len(shards) > 0:
+            for shard in shards:
+                yield from image_files(shard, image_size, preprocessing)
+            return
+
+        for fname in sorted(os.listdir(path)):
+            if fname.endswith(('.jpeg', '.jpg', '.npy')):
+                yield from image_files(os.path.join(path, fname), image_size, preprocessing)
+        return
+
+    if path.endswith('.npy'):
+        images = np.load(path, mmap_mode = 'r')
+        if images.ndim == 2 or (images.ndim == 3 and images.shape[-1] == 1):
+            yield path, cnn_input(images, image_size, preprocessing)
+        else:
+            for n in range(len(images)):
+                yield '{}:{}'.format(path, n), cnn_input(images[n], image_size, preprocessing)
+    elif path.endswith('.npz'):
+        with np.load(path) as shard:
+            images = shard['images']
+        for n in range(len(images)):
+            yield '{}:{}'.format(path, n), cnn_input(images[n], image_size, preprocessing)
+    else:
+        yield path, load_jpeg(path, image_size, preprocessing)
+
+
+class batcher(object):
+    """
+    Dynamic batching front end of a model (anything with predict_proba(images, B), such as a CNNModel). submit queues one image and
+    returns a Future of its probabilities; a worker thread takes the waiting requests as one batch once max_batch have arrived or the
+    oldest has waited max_latency seconds. Use as a context manager, or call close, to stop the worker.
+    """
+
+    def __init__(self, model, max_batch = 64, max_latency = 0.01):
+
+        self.model       = model
+        self.max_batch   = max_batch
+        self.max_latency = max_latency
+
+        # (submit time, image, future) of every waiting request
+        self.requests = queue.Queue()
+
+        # seconds from submit to result of every request, and the size and run time of every batch
+        self.latencies = []
+        self.batches   = []
+        self.first = self.last = None
+
+        self.stop   = threading.Event()
+        self.thread = threading.Thread(target = self._serve, daemon = True)
+        self.thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def submit(self, image):
+        """
+        Queues one CNN input image, returns a Future of its class probabilities.
+        """
+
+        future = Future()
+        self.requests.put((perf_counter(), np.asarray(image, dtype = np.float32), future))
+
+        return future
+
+    def score(self, images):
+        """
+        Class probabilities of a list or stack of CNN input images, as one array. The images are queued together, so they share batches
+        with any other requests.
+        """
+
+        futures = [self.submit(image) for image in images]
+
+        return np.array([future.result() for future in futures])
+
+    def _serve(self):
+        while not self.stop.is_set():
+            try:
+                pending = [self.requests.get(timeout = 0.1)]
+            except queue.Empty:
+                continue
+
+            # fill the batch until it is full or the oldest request is out of time
+            deadline = pending[0][0] + self.max_latency
+            while len(pending) < self.max_batch:
+                wait = deadline - perf_counter()
+                try:
+                    pending.append(self.requests.get(timeout = wait) if wait > 0 else self.requests.get_nowait())
+                except queue.Empty:
+                    break
+
+            start = perf_counter()
+            try:
+                probs = self.model.predict_proba(np.stack([p[1] for p in pending]), len(pending))
+            except Exception as error:
+                for p in pending:
+                    p[2].set_exception(error)
+                continue
+
+            done = perf_counter()
+            for (submitted, image, future), prob in zip(pending, probs):
+                future.set_result(prob)
+                self.latencies.append(done - submitted)
+            self.batches.append((len(pending), done - start))
+            if self.first is None:
+                self.first = pending[0][0]
+            self.last = done
+
+    def stats(self):
+        """
+        Images scored, throughput (images per second from the first request to the last result), mean batch size and the 50th, 90th and
+        99th percentile latencies in seconds.
+        """
+
+        n = len(self.latencies)
+        if n == 0:
+            return {'images': 0, 'throughput': 0.0, 'batches': 0, 'mean_batch': 0.0, 'p50': np.nan, 'p90': np.nan, 'p99': np.nan}
+
+        p50, p90, p99 = np.percentile(self.latencies, [50, 90, 99])
+
+        return {'images': n, 'throughput': n / max(self.last - self.first, 1e-9), 'batches': len(self.batches),
+                'mean_batch': n / len(self.batches), 'p50': p50, 'p90': p90, 'p99': p99}
+
+    def report(self):
+        """
+        Prints stats.
+        """
+
+        s = self.stats()
+        print('{} images in {} batches (mean {:.1f}), {:.1f} images/s, latency p50 {:.2f} ms, p90 {:.2f} ms, p99 {:.2f} ms'.format(
+              s['images'], s['batches'], s['mean_batch'], s['throughput'], 1e3*s['p50'], 1e3*s['p90'], 1e3*s['p99']))
+
+    def close(self):
+        self.stop.set()
+        self.thread.join()
+
+
+def score_files(service, path, image_size, preprocessing, out = None):
+    """
+    Scores every image in path (see image_files) with a batcher. Returns the image names and their probabilities, also written to
+    the CSV file out if given.
+    """
+
+    names, futures = [], []
+    for name, image in image_files(path, image_size, preprocessing):
+        names.append(name)
+        futures.append(service.submit(image))
+    probs = np.array([future.result() for future in futures])
+
+    if out is not None:
+        with open(out, 'w', newline = '') as f:
+            writer = csv.writer(f)
+            writer.writerow(['image', 'p_noise', 'p_sn'])
+            for name, prob in zip(names, probs):
+                writer.writerow([name] + list(prob))
+
+    return names, probs
+
+
+def serve_queue(service, requests, results, image_size, preprocessing):
+    """
+    Scores (key, image) items from a queue (e.g. a multiprocessing.Queue filled by another process) until it gets None, putting
+    (key, probabilities) on results in the order the scores are ready.
+    """
+
+    def answer(key, future):
+        future.add_done_callback(lambda f: results.put((key, f.result())))
+
+    while True:
+        item = requests.get()
+        if item is None:
+            return
+        answer(item[0], service.submit(cnn_input(item[1], image_size, preprocessing)))
+
+
+def serve_socket(service, image_size, preprocessing, address = ('localhost', 6000), authkey = AUTHKEY):
+    """
+    Listens on a local socket for clients (see score_remote). Each message is a stack of images, answered with their probabilities;
+    every connection is handled on its own thread, so requests from different clients are batched together. Runs until interrupted.
+    """
+
+    def handle(conn):
+        with conn:
+            while True:
+                try:
+                    images = conn.recv()
+                except EOFError:
+                    return
+                conn.send(service.score([cnn_input(image, image_size, preprocessing) for image in images]))
+
+    with Listener(address, authkey = authkey) as listener:
+        print('Listening on {}:{}'.format(*address))
+        while True:
+            conn = listener.accept()
+            threading.Thread(target = handle, args = (conn,), daemon = True).start()
+
+
+def score_remote(images, address = ('localhost', 6000), authkey = AUTHKEY):
+    """
+    Client of serve_socket: sends a stack of images (raw ADC or CNN input) and returns their class probabilities.
+    """
+
+    with Client(address, authkey = authkey) as conn:
+        conn.send(np.asarray(images, dtype = np.float32))
+        return conn.recv()
+
+
+def main(argv = None):
+
+    parser = argparse.ArgumentParser(description = 'Score unlabelled TPC images with a trained CNN.')
+    parser.add_argument('model', help = 'folder the model was saved to by run_cnn.main(..., model_path = ...)')
+    parser.add_argument('--images', default = None, help = 'JPEG, .npy file, dataset shard or folder of them to score')
+    parser.add_argument('--port', type = int, default = None, help = 'serve requests on this local port instead')
+    parser.add_argument('--out', default = 'scores.csv', help = 'CSV of the scores of --images')
+    parser.add_argument('--max-batch', type = int, default = 64, help = 'largest batch of requests scored at once')
+    parser.add_argument('--max-latency', type = float, default = 0.01, help = 'longest wait in seconds for a batch to fill')
+    args = parser.parse_args(argv)
+
+    if (args.images is None) == (args.port is None):
+        parser.error('give one of --images or --port')
+
+    # imported here so the clients of this module need no TensorFlow
+    from model_utils import load_model
+    model, preprocessing = load_model(args.model)
+    image_size = tuple(model.config['image_size'])
+
+    # trace the compiled forward pass before any request is timed
+    model.predict_proba(np.zeros((1, image_size[0], image_size[1], 1), dtype = np.float32))
+
+    with batcher(model, args.max_batch, args.max_latency) as service:
+        try:
+            if args.images is not None:
+                score_files(service, args.images, image_size, preprocessing, args.out)
+            else:
+                serve_socket(service, image_size, preprocessing, ('localhost', args.port))
+        except KeyboardInterrupt:
+            pass
+        service.report()
+
+
+if __name__ == '__main__':
+    main()
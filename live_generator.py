@@ -0,0 +1,163 @@
+"""
+Simulation-to-training generator that never touches disk. A pool of worker processes runs the simulation on randomly chosen events
+(or with the event removed, for noise-only images), downsamples each ADC image to the CNN input size and pushes it with its label
+into a bounded queue. run_cnn.py wraps the queue in a tf.data pipeline, so the CNN trains on a stream of fresh images with no
+storage footprint and no JPEG encode/decode. Physics parameters can be fixed or redrawn for every image.
+"""
+
+import multiprocessing as mp
+from queue import Empty, Full
+import numpy as np
+from PIL import Image
+from event_store import open_event_store
+from dataset_writer import NOISE, SN
+
+# fixed physics parameters of the lifetime scan in LArTPC_simulation.py; a (low, high) pair is drawn uniformly for every image instead
+DEFAULT_PARAMS = {'lifetime': 10, 't_coef': 7.4e-4, 'd_coef': 24e-4, 'screen': 10, 'activity': 1e-3}
+
+# how to_cnn_input prepares images, saved with models trained on them (see model_utils.ExtraUtils.save_model)
+PREPROCESSING = {'input': 'adc', 'resize': 'pil', 'offset': 450, 'scale': 4091 - 450, 'clip': True}
+
+
+def draw_params(params, rng):
+    """
+    Values of the physics parameters for one image: fixed values are kept, (low, high) ranges are sampled uniformly.
+    """
+
+    values = {}
+    for name, value in params.items():
+        if isinstance(value, (tuple, list)):
+            values[name] = float(rng.uniform(value[0], value[1]))
+        else:
+            values[name] = value
+
+    return values
+
+
+def to_cnn_input(image, image_size):
+    """
+    Downsamples a raw ADC image to image_size (rows, columns) with the bicubic filter run_cnn.load_images uses, scaled to [0, 1] over
+    the ADC range the JPEGs were saved with. An image simulated at image_size is only scaled.
+    """
+
+    small = Image.fromarray(np.asarray(image, dtype = np.float32), mode = 'F').resize((image_size[1], image_size[0]), Image.BICUBIC)
+    small = (np.asarray(small) - PREPROCESSING['offset']) / PREPROCESSING['scale']
+
+    return np.clip(small, 0, 1).astype(np.float32)[..., None]
+
+
+def _produce(queue, stop, seed, params, events, noise_frac, image_size, store_path, binning, library, resolution):
+    # imported here so the parent, which only reads the queue, never needs the simulation
+    from LArTPC_simulation import simulation
+    from background_library import load_library
+
+    store = open_event_store(store_path)
+    if isinstance(library, str):
+        library = load_library(library)
+    if events is None:
+        events = store.event_ids
+
+    rng = np.random.default_rng(seed)
+    while not stop.is_set():
+        values = draw_params(params, rng)
+        label  = NOISE if rng.uniform() < noise_frac else SN
+
+        sim = simulation(int(rng.choice(events)), values['screen'], values['lifetime'], values['t_coef'], values['d_coef'],
+                         activity = values['activity'], store = store, binning = binning, seed = seed.spawn(1)[0], run = False,
+                         library = library, resolution = resolution, verbose = False)
+
+        # a noise-only image keeps the event's drift window (and so its background) but none of its charge
+        sim.SIGNAL = label != NOISE
+
+        item = (to_cnn_input(sim.lifetime_stage(values['lifetime']), image_size), np.eye(2, dtype = np.float32)[label])
+
+        # block while the queue is full, but keep checking for close
+        while not stop.is_set():
+            try:
+                queue.put(item, timeout = 0.5)
+                break
+            except Full:
+                pass
+
+
+class live_generator(object):
+    """
+    Pool of simulation workers filling a bounded queue with (image, one-hot label) pairs. Iterating yields pairs for ever; use as a
+    context manager, or call close, to stop the workers.
+
+    params maps lifetime, t_coef, d_coef, screen and activity to a fixed value or a (low, high) range. events restricts the GEANT4 events
+    used (default: all of them) and noise_frac is the fraction of noise-only images. With native = True the simulation bins straight onto
+    the image_size grid (see simulation.grid) rather than simulating full resolution images and downsampling them.
+    """
+
+    def __init__(self, params = None, events = None, noise_frac = 0.5, image_size = (100,100), processes = None, queue_size = 256,
+                 root_seed = 0, store_path = 'event_store', binning = 'sample', library = None, native = False):
+
+        self.params = dict(DEFAULT_PARAMS)
+        if params is not None:
+            self.params.update(params)
+
+        # make sure the event store exists before the workers open it
+        open_event_store(store_path)
+
+        if processes is None:
+            processes = mp.cpu_count()
+
+        # spawned workers, so the parent's TensorFlow runtime is never forked
+        ctx = mp.get_context('spawn')
+        self.queue = ctx.Queue(maxsize = queue_size)
+        self.stop  = ctx.Event()
+
+        # one independent random stream per worker
+        seeds = np.random.SeedSequence(root_seed).spawn(processes)
+        self.workers = [ctx.Process(target = _produce, args = (self.queue, self.stop, seed, self.params, events, noise_frac, image_size,
+                                                               store_path, binning, library, tuple(image_size) if native else None), 
+                                 daemon = True) for seed in seeds]
+        for worker in self.workers:
+            worker.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __iter__(self):
+        while True:
+            yield self.get()
+
+    def get(self):
+        """
+        Next (image, label) pair, waiting for a worker if the queue is empty.
+        """
+
+        while True:
+            try:
+                return self.queue.get(timeout = 1)
+            except Empty:
+                if not any(worker.is_alive() for worker in self.workers):
+                    raise RuntimeError('every simulation worker has exited')
+
+    def sample(self, num_images):
+        """
+        Takes num_images pairs off the queue as (images, labels) arrays, e.g. for a fixed validation or test set.
+        """
+
+        pairs = [self.get() for i in range(num_images)]
+
+        return np.stack([p[0] for p in pairs]), np.stack([p[1] for p in pairs])
+
+    def close(self):
+        self.stop.set()
+
+        # empty the queue so no worker is left blocked on a put
+        try:
+            while True:
+                self.queue.get_nowait()
+        except Empty:
+            pass
+
+        for worker in self.workers:
+            worker.join(timeout = 5)
+            if worker.is_alive():
+                worker.terminate()
@@ -1,9 +1,10 @@
 """
 This code actually creates the CNN model, with the architecture defined in CNN model class. ExtraUtils is used to 
-perform the training,testing and validation steps. 
+perform the training,testing and validation steps. Trained models are saved with save_model and restored with load_model.
 """
 
 import os 
+import json
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'  
 import tensorflow as tf
 from tensorflow.keras import Model 
@@ -15,22 +16,33 @@ import numpy as np
 
 class ExtraUtils(Model):
     """
-    Class performs test, train and validation steps. Also contains functions to return the model weights.
+    Class performs test, train and validation steps. Also contains functions to return the model weights. The steps are compiled 
+    with tf.function and accumulate loss and accuracy in metric objects, which are only read back once per epoch.
     """
 
-    def __init__(self, optimizer, loss_calc):
+    def __init__(self, optimizer, loss_calc, image_size=(100,100)):
         super(ExtraUtils, self).__init__()
         self.optimizer = optimizer()
         self.loss_calc = loss_calc()
         self.bn_idxs = None 
+        self.train_loss = tf.keras.metrics.Mean()
+        self.train_acc = tf.keras.metrics.CategoricalAccuracy()
+        self.test_loss = tf.keras.metrics.Mean()
+        self.test_acc = tf.keras.metrics.CategoricalAccuracy()
+
+        # compiled steps with a fixed signature: any batch size of greyscale image_size images and one-hot labels 
+        signature = [tf.TensorSpec([None, image_size[0], image_size[1], 1], tf.float32),
+                     tf.TensorSpec([None, None], tf.float32)]
+        self.train_step = tf.function(self._train_step, input_signature=signature)
+        self._test_xy = tf.function(self._test_step, input_signature=signature)
+        self._predict_x = tf.function(lambda x: self.fwd_test(x), input_signature=signature[:1])
         
-    def train_step(self, images, labels):
+    def _train_step(self, images, labels):
         grads, loss, preds = self.get_grads_loss_preds(images, labels)
         self.optimizer.apply_gradients(zip(grads, self.trainable_variables))
         
-        acc = np.mean(np.argmax(preds.numpy(), axis=0) 
-                        == np.argmax(labels, axis=0))
-        return acc, loss.numpy()
+        self.train_loss.update_state(loss, sample_weight=tf.cast(tf.shape(labels)[0], tf.float32))
+        self.train_acc.update_state(labels, preds)
         
     def get_grads_loss_preds(self, images, labels):
         with tf.GradientTape() as tape:
@@ -39,51 +51,122 @@ class ExtraUtils(Model):
             
         gradients = tape.gradient(loss, self.trainable_variables)
         return gradients, loss, predictions
+
+    def batches(self, x, y, B, idx=None):
+        """
+        Yields (images, labels) batches of size B from arrays, or the batches of an already batched tf.data pipeline. If idx is given, 
+        batches are gathered from those rows of the arrays in that order, copying only one batch at a time. The rows of a batch are 
+        read in ascending order (sequential reads of a memory-mapped array) and then put back in idx order, so predictions line up 
+        with y[idx].
+        """
+        if isinstance(x, tf.data.Dataset):
+            for batch in x:
+                yield batch
+            return
+
+        if idx is None:
+            for b in range(0, x.shape[0], B):
+                yield x[b:b+B], y[b:b+B]
+            return
+
+        idx = np.asarray(idx)
+        for b in range(0, len(idx), B):
+            rows = idx[b:b+B]
+            order = np.argsort(rows, kind='stable')
+            undo = np.argsort(order)
+            yield x[rows[order]][undo], y[rows[order]][undo]
         
     def train(self, client_data, B):
-        x = client_data[0] 
-        y = client_data[1]
-        b_pr_e = x.shape[0] // B 
-        
-        for b in range(b_pr_e):
-            self.train_step(x[b*B:(b+1)*B], y[b*B:(b+1)*B])
-        if b_pr_e * B < x.shape[0]:
-            self.train_step(x[b_pr_e*B:], y[b_pr_e*B:])
+        """
+        One epoch of training on (images, labels) arrays, (images, labels, row indices) or a tf.data pipeline. Returns the epoch's 
+        training loss and accuracy.
+        """
+        self.train_loss.reset_state()
+        self.train_acc.reset_state()
+
+        if isinstance(client_data, tf.data.Dataset):
+            # already batched (and shuffled) by the input pipeline 
+            batches = self.batches(client_data, None, B)
+        else:
+            batches = self.batches(*client_data[:2], B, *client_data[2:])
+
+        for x, y in batches:
+            self.train_step(x, y)
+
+        return float(self.train_loss.result()), float(self.train_acc.result())
               
-    def _test_xy(self, x, y):
+    def _test_step(self, x, y):
         preds = self.fwd_test(x)
-        loss = self.loss_calc(y, preds).numpy()
-        acc = np.mean(np.argmax(preds.numpy(), axis=1) 
-                        ==  np.argmax(y, axis=1))
-        return loss, acc, preds 
+        loss = self.loss_calc(y, preds)
+
+        self.test_loss.update_state(loss, sample_weight=tf.cast(tf.shape(y)[0], tf.float32))
+        self.test_acc.update_state(y, preds)
+        return preds 
             
-    def test(self, x_vals, y_vals, B):
+    def test(self, x_vals, y_vals, B, idx=None):
+        """
+        Evaluates arrays (the rows idx of them, if given) or a tf.data pipeline (y_vals unused). Returns the mean loss and accuracy over 
+        all samples and the list of per-batch predictions.
+        """
+        self.test_loss.reset_state()
+        self.test_acc.reset_state()
+
         pred_list = []
-        b_pr_t = x_vals.shape[0] // B 
-        avg_err = 0.0 
-        avg_acc = 0.0 
-        tot_samples = 0
-        for b in range(b_pr_t):
-            loss, acc, preds = self._test_xy(x_vals[b*B:(b+1)*B], y_vals[b*B:(b+1)*B])
-            avg_err += loss
-            avg_acc += acc 
-            tot_samples += 1
-            pred_list.append(preds)
-        if b_pr_t * B < x_vals.shape[0]:
-            loss, acc, preds = self._test_xy(x_vals[b_pr_t*B:], y_vals[b_pr_t*B:])
-            avg_err += loss 
-            avg_acc += acc 
-            tot_samples += 1 
-            pred_list.append(preds)
-        return avg_err / tot_samples, avg_acc / tot_samples, pred_list
+        for x, y in self.batches(x_vals, y_vals, B, idx):
+            pred_list.append(self._test_xy(x, y))
+        return float(self.test_loss.result()), float(self.test_acc.result()), pred_list
+
+    def predict_proba(self, x, B=64):
+        """
+        Class probabilities of unlabelled images, an (N, rows, columns, 1) array, evaluated B at a time. 
+        """
+        x = np.asarray(x, dtype=np.float32)
+        probs = [self._predict_x(x[b:b+B]).numpy() for b in range(0, len(x), B)]
+        return np.concatenate(probs) if len(probs) > 0 else np.zeros((0, self.d2.units), dtype=np.float32)
+
+    def save_model(self, path, preprocessing=None):
+        """
+        Saves the weights of every layer in layer_list, as weights.npz, and the arguments the model was built with, as config.json, to 
+        the folder path for load_model. preprocessing records how the training images were made from raw images (see 
+        run_cnn.input_preprocessing), so inference_service can prepare its inputs the same way. 
+        """
+        os.makedirs(path, exist_ok=True)
+        with open(os.path.join(path, 'config.json'), 'w') as f:
+            json.dump(dict(self.config, preprocessing=preprocessing), f)
+        np.savez(os.path.join(path, 'weights.npz'), **{'{}_{}'.format(i, j): w for i, layer in enumerate(self.layer_list)
+                                                        for j, w in enumerate(layer.get_weights())})
+
+    def save_optimizer(self, path):
+        """
+        Saves the optimizer state (step count, learning rate and moments) to optimizer.npz in the folder path, to resume training. 
+        """
+        np.savez(os.path.join(path, 'optimizer.npz'), *[v.numpy() for v in self.optimizer.variables])
+
+    def load_optimizer(self, path):
+        """
+        Restores the optimizer state written by save_optimizer. The layers must have been built, as for load_weights_npz. 
+        """
+        self.optimizer.build(self.trainable_variables)
+        with np.load(os.path.join(path, 'optimizer.npz')) as state:
+            for i, v in enumerate(self.optimizer.variables):
+                v.assign(state['arr_{}'.format(i)])
+
+    def load_weights_npz(self, path):
+        """
+        Sets the layer weights from the weights.npz written by save_model. The layers must have been built, e.g. by one forward pass. 
+        """
+        with np.load(os.path.join(path, 'weights.npz')) as weights:
+            for i, layer in enumerate(self.layer_list):
+                layer.set_weights([weights['{}_{}'.format(i, j)] for j in range(len(layer.get_weights()))])
 
 class CNNModel(ExtraUtils):
 
-    def __init__(self, optimizer, loss_calc, outputs, activation):
+    def __init__(self, optimizer, loss_calc, outputs, activation, image_size=(100,100)):
         """ 
         The CNN model layers are created here. 
         """
-        super(CNNModel, self).__init__(optimizer, loss_calc) 
+        super(CNNModel, self).__init__(optimizer, loss_calc, image_size) 
+        self.config = {'outputs': outputs, 'activation': activation, 'image_size': list(image_size)}
         self.conv1 = Conv2D(32, 3, activation='relu')
         self.pool1 = MaxPool2D((2,2), (2,2))
         self.conv2 = Conv2D(64, 3, activation='relu')
@@ -97,21 +180,34 @@ class CNNModel(ExtraUtils):
         self.layer_list = [self.conv1, self.conv2,
                             self.d1, self.d2]
 
+    def forward(self, x, training):
+        a = self.conv1(x, training=training)
+        a = self.pool1(a, training=training)
+        a = self.conv2(a, training=training)
+        a = self.pool2(a, training=training)
+        a = self.flatten(a, training=training)
+        a = self.d1(a, training=training)
+        return self.d2(a, training=training)
+
     def fwd_train(self, x):
-        a = self.conv1(x)
-        a = self.pool1(a)
-        a = self.conv2(a)
-        a = self.pool2(a)
-        a = self.flatten(a)
-        a = self.d1(a)
-        return self.d2(a)
+        return self.forward(x, training=True)
         
     def fwd_test(self, x):
-        a = self.conv1(x)
-        a = self.pool1(a)
-        a = self.conv2(a)
-        a = self.pool2(a)
-        a = self.flatten(a)
-        a = self.d1(a)
-        return self.d2(a)
-        
\ No newline at end of file
+        return self.forward(x, training=False)
+        
+
+
+def load_model(path, optimizer=Adam, loss_calc=CategoricalCrossentropy):
+    """
+    Rebuilds a CNNModel saved with save_model. The optimizer starts afresh, so the model is ready for inference or further training. 
+    Returns the model and the preprocessing it was saved with (None if not known). 
+    """
+    with open(os.path.join(path, 'config.json')) as f:
+        config = json.load(f)
+
+    model = CNNModel(optimizer, loss_calc, config['outputs'], config['activation'], tuple(config['image_size']))
+
+    # run the model once so its layers exist to load the weights into 
+    model.fwd_test(tf.zeros((1, config['image_size'][0], config['image_size'][1], 1)))
+    model.load_weights_npz(path)
+    return model, config.get('preprocessing')
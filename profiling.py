@@ -0,0 +1,91 @@
+"""
+Opt-in per-stage instrumentation of the simulation. A stage_profiler passed to simulation(..., profiler = ...) records one structured
+record per stage run (data load, transport, radiological generation, smearing, diffusion, binning, background overlay, digitization
+and output) with its wall time, the number of electrons it handled and the peak memory it allocated above what was in use when it
+started. Stages can nest (smearing runs inside radiological generation), in which case the outer record includes the inner one.
+"""
+
+import tracemalloc
+from contextlib import contextmanager
+from time import perf_counter
+
+
+class stage_profiler(object):
+    """
+    Collects {'stage', 'wall', 'electrons', 'peak_memory', ...} records, in the order stages finish. Peak memory is traced with
+    tracemalloc (numpy reports its allocations to it), which slows Python-heavy code down; pass memory = False to only time.
+    """
+
+    def __init__(self, memory = True):
+
+        self.memory  = memory
+        self.records = []
+
+        # records of the stages currently running, outermost first, with the peak traced memory seen inside each
+        self.open = []
+
+        # whether tracing was started here, and so should be stopped when the outermost stage ends
+        self.started = False
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Times the body of the with block as one stage. Yields its record, so the stage can add counts such as electrons.
+        """
+
+        record = {'stage': name, 'wall': 0.0, 'electrons': None, 'peak_memory': None}
+
+        if self.memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self.started = True
+
+            # hand the peak so far to the enclosing stage before restarting the peak for this one
+            current, peak = tracemalloc.get_traced_memory()
+            if len(self.open) > 0:
+                self.open[-1]['peak'] = max(self.open[-1]['peak'], peak)
+            tracemalloc.reset_peak()
+            self.open.append({'start': current, 'peak': current})
+
+        start = perf_counter()
+        try:
+            yield record
+        finally:
+            record['wall'] = perf_counter() - start
+
+            if self.memory:
+                mine = self.open.pop()
+                peak = max(mine['peak'], tracemalloc.get_traced_memory()[1])
+                record['peak_memory'] = peak - mine['start']
+                if len(self.open) > 0:
+                    self.open[-1]['peak'] = max(self.open[-1]['peak'], peak)
+                elif self.started:
+                    tracemalloc.stop()
+                    self.started = False
+
+            self.records.append(record)
+
+    def summary(self):
+        """
+        Totals per stage, in the order each stage first finished: calls, wall time, electrons and the largest peak memory.
+        """
+
+        totals = {}
+        for record in self.records:
+            total = totals.setdefault(record['stage'], {'stage': record['stage'], 'calls': 0, 'wall': 0.0, 'electrons': 0, 'peak_memory': 0})
+            total['calls'] += 1
+            total['wall']  += record['wall']
+            total['electrons']   += record['electrons'] or 0
+            total['peak_memory']  = max(total['peak_memory'], record['peak_memory'] or 0)
+
+        return list(totals.values())
+
+    def report(self):
+        """
+        Prints the per-stage summary as a table.
+        """
+
+        print('{:<14}{:>7}{:>12}{:>14}{:>14}'.format('stage', 'calls', 'wall (s)', 'electrons', 'peak (MB)'))
+        for total in self.summary():
+            print('{:<14}{:>7}{:>12.4f}{:>14}{:>14.2f}'.format(total['stage'], total['calls'], total['wall'], total['electrons'],
+                                                               total['peak_memory'] / 2**20))
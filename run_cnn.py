@@ -1,10 +1,13 @@
 from PIL import Image
 import os
+import re
+import json
+import shutil
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
 os.environ['TF_FORCE_GPU_ALLOW_GROWTH'] = 'true'
 import numpy as np
 import matplotlib.pyplot as plt
-from model_utils import CNNModel, BigCNNModel
+from model_utils import CNNModel
 import tensorflow as tf
 from tensorflow.keras.losses import CategoricalCrossentropy as CatCrossEnt
 from tensorflow.keras.optimizers import SGD, Adam
@@ -14,6 +17,11 @@ import sklearn.metrics
 import seaborn as sn 
 import pandas as pd 
 import time 
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import get_context, shared_memory
+from dataset_writer import shard_names
+from live_generator import live_generator, PREPROCESSING as LIVE_PREPROCESSING
+from image_cache import open_image_cache, image_cache, packed_images
 np.random.seed(0)
 tf.random.set_seed(0)
 
@@ -30,17 +38,146 @@ def load_images(folder, max_ims, image_size):
     feat_label = np.array([0, 1], dtype=np.float32)
 
     for (i, fname) in enumerate(fnames):
-        img = np.array(Image.open(folder+'/'+fname).resize(image_size))
+        img = np.array(Image.open(folder+'/'+fname).convert('L').resize(image_size))
         
         imgs[i] = img[:,:][:,:]
         labels[i] = feat_label if 'sn' in fname else noise_label
 
-    imgs = imgs.reshape((max_ims, image_size[0], image_size[0], 1))
+    imgs = imgs.reshape((tot_imgs, image_size[0], image_size[1], 1))
     imgs /= np.amax(imgs)
 
     return (imgs, labels)
 
 
+def load_cached_images(folder, max_ims, image_size, cache_dir=None):
+    """
+    load_images through an image_cache, built on the first call for a folder and size. Returns the picked images as packed_images, 
+    memory-mapped uint8 converted to float32 a batch at a time and normalised by their maximum pixel as in load_images, and the labels.
+    """
+    cache = open_image_cache(folder, image_size, cache_dir)
+    order = np.random.permutation(len(cache))[:max_ims]
+    labels = np.eye(2, dtype=np.float32)[cache.labels[order]]
+
+    return packed_images(cache.images, np.amax(cache.maxima[order]), order), labels
+
+
+def input_preprocessing(kind, resize, scale):
+    """
+    Record of how the CNN inputs were made from raw images, saved with a trained model for inference_service: 'jpeg' (greyscale) or 
+    'adc' (raw ADC) images, resized with 'pil' (PIL's bicubic filter) or 'tf' (tf.image bicubic, antialiased) and divided by scale, the 
+    maximum pixel of the dataset.
+    """
+    return {'input': kind, 'resize': resize, 'offset': 0.0, 'scale': float(scale), 'clip': False}
+
+
+def image_index(folder, max_ims):
+    """
+    Lists the images in a folder of JPEGs or dataset shards, shuffled and cut to max_ims. Returns a list of sources (JPEG paths, or 
+    (shard path, index) pairs) and the one-hot labels, noise = [1,0] and sn = [0,1].
+    """
+
+    shards = shard_names(folder)
+    if len(shards) > 0:
+        sources, classes = [], []
+        for path in shards:
+            # only the label array of each shard is read here 
+            with np.load(path) as shard:
+                shard_labels = shard['label']
+            sources += [(path, i) for i in range(len(shard_labels))]
+            classes += list(shard_labels)
+    else:
+        fnames  = sorted(f for f in os.listdir(folder) if f.endswith('.jpeg'))
+        sources = [os.path.join(folder, f) for f in fnames]
+        classes = [1 if 'sn' in f else 0 for f in fnames]
+
+    order = np.random.permutation(len(sources))[:max_ims]
+    sources = [sources[i] for i in order]
+    labels  = np.eye(2, dtype=np.float32)[np.array(classes, dtype=np.int64)[order]]
+
+    return sources, labels
+
+
+def image_stream(sources, labels, image_size):
+    """
+    Unbatched tf.data pipeline of (image, label) pairs, decoded and resized in parallel. JPEGs are decoded to greyscale; dataset shards 
+    are read a shard at a time through a generator, so shard sources should be sorted to keep their order.
+    """
+
+    AUTOTUNE = tf.data.experimental.AUTOTUNE
+
+    if len(sources) > 0 and isinstance(sources[0], tuple):
+        def generate():
+            wanted = {}
+            for n, (path, i) in enumerate(sources):
+                wanted.setdefault(path, []).append((i, n))
+            for path, members in wanted.items():
+                with np.load(path) as shard:
+                    images = shard['images']
+                for i, n in members:
+                    yield images[i][..., None], labels[n]
+
+        ds = tf.data.Dataset.from_generator(generate, output_signature = (tf.TensorSpec((None, None, 1), tf.float32),
+                                                                          tf.TensorSpec((2,), tf.float32)))
+    else:
+        ds = tf.data.Dataset.from_tensor_slices((sources, labels))
+        ds = ds.map(lambda path, label: (tf.cast(tf.io.decode_jpeg(tf.io.read_file(path), channels = 1), tf.float32), label), 
+                    num_parallel_calls = AUTOTUNE)
+
+    # bicubic resize antialiased when downsampling, as PIL's bicubic filter in load_images is 
+    return ds.map(lambda img, label: (tf.image.resize(img, image_size, method = 'bicubic', antialias = True), label), num_parallel_calls = AUTOTUNE)
+
+
+def stream_images(folder, max_ims, image_size, batch, train_frac, valid_frac, test_frac, shuffle_buffer=1024):
+    """
+    Streaming replacement for load_images + split_data_train_valid_test. Returns batched, prefetched tf.data pipelines for the train, 
+    validation and test sets, the test labels in order and the input_preprocessing of the images. Images are normalised by the maximum 
+    pixel value of the dataset, found in one streaming pass, and the training set is reshuffled every epoch through a bounded buffer, so 
+    memory stays bounded however many images the folder holds.
+    """
+
+    assert train_frac + valid_frac + test_frac == 1.0
+    AUTOTUNE = tf.data.experimental.AUTOTUNE
+
+    sources, labels = image_index(folder, max_ims)
+    train_idx = int(len(sources) * train_frac)
+    valid_idx = train_idx + int(len(sources) * valid_frac)
+
+    # one pass over the dataset for its normalisation 
+    scale = image_stream(sources, labels, image_size).map(lambda img, label: tf.reduce_max(img), num_parallel_calls = AUTOTUNE)
+    scale = scale.reduce(tf.constant(0.0), tf.maximum)
+
+    def split(start, stop):
+        idx = np.arange(start, stop)
+        if len(idx) > 0 and isinstance(sources[0], tuple):
+            # read each shard once, in order 
+            idx = sorted(idx, key = lambda n: sources[n])
+        return [sources[n] for n in idx], labels[idx]
+
+    def pipeline(start, stop, shuffle):
+        ds = image_stream(*split(start, stop), image_size)
+        if shuffle:
+            ds = ds.shuffle(shuffle_buffer, reshuffle_each_iteration=True)
+        ds = ds.map(lambda img, label: (img / scale, label), num_parallel_calls = AUTOTUNE)
+        return ds.batch(batch).prefetch(AUTOTUNE)
+
+    train = pipeline(0, train_idx, True)
+    valid = pipeline(train_idx, valid_idx, False)
+    test  = pipeline(valid_idx, len(sources), False)
+
+    kind = 'adc' if len(sources) > 0 and isinstance(sources[0], tuple) else 'jpeg'
+    return train, valid, test, split(valid_idx, len(sources))[1], input_preprocessing(kind, 'tf', scale)
+
+
+def live_dataset(generator, image_size, batch):
+    """
+    Endless, batched tf.data pipeline of freshly simulated (image, label) pairs taken from a live_generator's queue.
+    """
+
+    ds = tf.data.Dataset.from_generator(lambda: iter(generator), output_signature = (tf.TensorSpec((image_size[0], image_size[1], 1), tf.float32),
+                                                                                    tf.TensorSpec((2,), tf.float32)))
+    return ds.batch(batch).prefetch(tf.data.experimental.AUTOTUNE)
+
+
 def split_data_train_valid_test(data, train_frac, valid_frac, test_frac):
     assert train_frac + valid_frac + test_frac == 1.0
     tot_samples = data[0].shape[0]
@@ -60,7 +197,60 @@ def shuffle_data(data):
 
 
 
-def main(optimizer, epochs, batch, activation, all_data):
+def save_checkpoint(model, folder, epoch, accuracy):
+    """
+    Saves the model and optimizer state, the validation accuracies so far and numpy's random state after epoch epochs to 
+    folder/epoch_XXX, and removes every other checkpoint in folder. state.json is written last, so only complete checkpoints are resumed.
+    """
+    path = os.path.join(folder, 'epoch_{:03d}'.format(epoch))
+    model.save_model(path)
+    model.save_optimizer(path)
+    kind, keys, pos, has_gauss, gauss = np.random.get_state()
+    with open(os.path.join(path, 'state.json'), 'w') as f:
+        json.dump({'epoch': epoch, 'accuracy': accuracy, 'random_state': [kind, keys.tolist(), pos, has_gauss, gauss]}, f)
+
+    for name in os.listdir(folder):
+        if name.startswith('epoch_') and name != os.path.basename(path):
+            shutil.rmtree(os.path.join(folder, name))
+
+
+def latest_checkpoint(folder):
+    """
+    Path of the last complete checkpoint saved in folder, or None.
+    """
+    if not os.path.isdir(folder):
+        return None
+    done = sorted(name for name in os.listdir(folder) if os.path.isfile(os.path.join(folder, name, 'state.json')))
+    return os.path.join(folder, done[-1]) if len(done) > 0 else None
+
+
+def restore_checkpoint(model, path):
+    """
+    Loads a checkpoint written by save_checkpoint into a freshly made model and restores numpy's random state, so the epochs after it 
+    shuffle as they would have without the interruption. Returns the epochs done and their validation accuracies.
+    """
+    with open(os.path.join(path, 'state.json')) as f:
+        state = json.load(f)
+
+    # run the model once so its layers exist to load the weights into 
+    model.fwd_test(tf.zeros((1, model.config['image_size'][0], model.config['image_size'][1], 1)))
+    model.load_weights_npz(path)
+    model.load_optimizer(path)
+
+    kind, keys, pos, has_gauss, gauss = state['random_state']
+    np.random.set_state((kind, np.array(keys, dtype=np.uint32), pos, has_gauss, gauss))
+    return state['epoch'], state['accuracy']
+
+
+def main(optimizer, epochs, batch, activation, all_data, model_path=None, checkpoint=None, preprocessing=None):
+    """
+    Trains and tests a CNN on all_data: a folder of JPEGs or dataset shards (streamed), an (images, labels) pair of arrays, or a 
+    live_generator of freshly simulated images. The trained model is saved to the folder model_path, if given, for 
+    model_utils.load_model, with the input_preprocessing of the images. Folders, live_generators and packed_images know their own; 
+    pass it for other arrays (otherwise inference_service only scores already prepared images). With a checkpoint folder, the model 
+    is checkpointed after every epoch and training resumes from the last checkpoint there. Returns the test accuracy, loss and 
+    confusion matrix.
+    """
     IMG_SIZE = (100,100)
     NUM_IMGS = 4000
     EPOCHS = epochs 
@@ -74,20 +264,54 @@ def main(optimizer, epochs, batch, activation, all_data):
     
     
     
-    all_data = shuffle_data(all_data)
-    train, valid, test = split_data_train_valid_test(   all_data, TRAIN_FRAC,
-                                                        VALID_FRAC, TEST_FRAC)
+    if isinstance(all_data, str):
+        # stream the images from the folder instead of holding them all in memory 
+        train, valid, test, test_labels, preprocessing = stream_images(all_data, NUM_IMGS, IMG_SIZE, BATCH_SIZE, TRAIN_FRAC, 
+                                                                       VALID_FRAC, TEST_FRAC)
+        test = (test, test_labels)
+    elif isinstance(all_data, live_generator):
+        # fixed validation and test sets, then every epoch trains on NUM_IMGS*TRAIN_FRAC images never seen before 
+        x, y = all_data.sample(int(NUM_IMGS * VALID_FRAC) + int(NUM_IMGS * TEST_FRAC))
+        valid_idx = int(NUM_IMGS * VALID_FRAC)
+        valid = (x, y, np.arange(valid_idx))
+        test = (x, y, np.arange(valid_idx, len(x)))
+        train = live_dataset(all_data, IMG_SIZE, BATCH_SIZE).take(int(NUM_IMGS * TRAIN_FRAC) // BATCH_SIZE)
+        preprocessing = LIVE_PREPROCESSING
+    else:
+        # shuffle and split by index, so the (possibly shared) image array is only copied a batch at a time 
+        x, y = all_data
+        if preprocessing is None and isinstance(x, packed_images):
+            # JPEGs resized by PIL into an image cache 
+            preprocessing = input_preprocessing('jpeg', 'pil', x.scale)
+        order = np.random.permutation(x.shape[0])
+        train_idx = int(len(order) * TRAIN_FRAC)
+        valid_idx = train_idx + int(len(order) * VALID_FRAC)
+        train = (x, y, order[:train_idx])
+        valid = (x, y, order[train_idx:valid_idx])
+        test = (x, y, order[valid_idx:])
     
-    model = CNNModel(optimizer, CatCrossEnt, 2, activation)
+    model = CNNModel(optimizer, CatCrossEnt, 2, activation, IMG_SIZE)
+    done = 0
+    if checkpoint is not None and latest_checkpoint(checkpoint) is not None:
+        done, accuracy = restore_checkpoint(model, latest_checkpoint(checkpoint))
+        print('Resuming after epoch {}'.format(done))
     print('Training...')
     prev_acc = 0
     count = 0  
-    for e in range(EPOCHS):
-        model.train(shuffle_data(train), BATCH_SIZE)
-        err, acc, preds = model.test(valid[0], valid[1], BATCH_SIZE)
+    for e in range(done, EPOCHS):
+        if isinstance(train, tf.data.Dataset):
+            model.train(train, BATCH_SIZE)
+        else:
+            model.train((train[0], train[1], np.random.permutation(train[2])), BATCH_SIZE)
+        if isinstance(valid, tf.data.Dataset):
+            err, acc, preds = model.test(valid, None, BATCH_SIZE)
+        else:
+            err, acc, preds = model.test(valid[0], valid[1], BATCH_SIZE, valid[2])
         print('Epoch {}/{}, valid err = {:.2f}, valid acc = {:.2f}'
                     .format(e, EPOCHS, err, acc))
         accuracy.append(acc)
+        if checkpoint is not None:
+            save_checkpoint(model, checkpoint, e + 1, accuracy)
 
         # if acc > prev_acc:
         #     count = 0 
@@ -97,19 +321,173 @@ def main(optimizer, epochs, batch, activation, all_data):
         #     print('No longer improving - > moving to test') 
         #     break  
         # prev_acc = acc
-    err2, acc2, preds = model.test(test[0], test[1], BATCH_SIZE)
+    if isinstance(test[0], tf.data.Dataset):
+        err2, acc2, preds = model.test(test[0], None, BATCH_SIZE)
+        actual = np.argmax(test[1], axis = 1)
+    else:
+        err2, acc2, preds = model.test(test[0], test[1], BATCH_SIZE, test[2])
+        actual = np.argmax(test[1][test[2]], axis = 1)
     
     # obtain predicted labels 
     preds = [val for sublist in preds for val in sublist]
     preds = np.argmax(preds, axis = 1)
-    actual = np.argmax(test[1], axis = 1)
-    confusion = confusion_matrix(actual, preds)
+    confusion = confusion_matrix(actual, preds, labels = [0, 1])
     
     print('test accuracy:', acc2)
 
+    if model_path is not None:
+        model.save_model(model_path, preprocessing)
     
     return acc2, err2, confusion 
 
+def share_array(array):
+    """
+    Copies an array into a new shared memory block. Returns the block (to unlink when done) and the spec workers attach with.
+    """
+    shm = shared_memory.SharedMemory(create=True, size=array.nbytes)
+    np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)[:] = array
+    return shm, (shm.name, array.shape, array.dtype.str)
+
+
+def attach_array(spec):
+    """
+    Zero-copy view of an array shared by share_array. The block must be kept open while the view is used.
+    """
+    shm = shared_memory.SharedMemory(name=spec[0])
+    return shm, np.ndarray(spec[1], dtype=np.dtype(spec[2]), buffer=shm.buf)
+
+
+def _init_sweep_worker(threads):
+    # limit TensorFlow's thread pools so concurrent runs don't oversubscribe the cores 
+    tf.config.threading.set_intra_op_parallelism_threads(threads)
+    tf.config.threading.set_inter_op_parallelism_threads(threads)
+
+
+def _sweep_run(dataset, run, images_spec, labels, epochs, batch, seed, checkpoint=None):
+    # seeds numpy, python and the Keras weight initialisers too, so the recorded seed reproduces the run 
+    tf.keras.utils.set_random_seed(seed)
+    if isinstance(images_spec, dict):
+        # every worker memory-maps the same image cache, which the OS page cache shares between them 
+        shm = None
+        images = packed_images(image_cache(images_spec['cache']).images, images_spec['scale'], images_spec['order'])
+    else:
+        shm, images = attach_array(images_spec)
+    try:
+        acc, err, confusion = main(Adam, epochs, batch, 'softmax', (images, labels), checkpoint=checkpoint)
+    finally:
+        del images
+        if shm is not None:
+            shm.close()
+    return dataset, run, acc, err, confusion
+
+
+class sweep_store(object):
+    """
+    On-disk state of a run_sweep in folder, so an interrupted sweep picks up where it stopped: runs/ holds a JSON record (accuracy, loss, 
+    confusion matrix and seed) of every finished (dataset, run), written as soon as it finishes, and checkpoints/ the per-epoch 
+    checkpoints of the runs in progress.
+    """
+
+    def __init__(self, folder):
+        self.folder = folder
+        os.makedirs(os.path.join(folder, 'runs'), exist_ok=True)
+
+    def name(self, dataset, run):
+        return '{}_run{}'.format(re.sub(r'[^\w.-]+', '_', os.path.normpath(dataset)).strip('_'), run)
+
+    def checkpoint(self, dataset, run):
+        return os.path.join(self.folder, 'checkpoints', self.name(dataset, run))
+
+    def result(self, dataset, run):
+        """
+        Record of a finished (dataset, run), or None.
+        """
+        path = os.path.join(self.folder, 'runs', self.name(dataset, run) + '.json')
+        if not os.path.isfile(path):
+            return None
+        with open(path) as f:
+            return json.load(f)
+
+    def save_result(self, dataset, run, acc, err, confusion, seed):
+        """
+        Records a finished (dataset, run) and removes its checkpoints. The record is written to a temporary file and renamed, so it is 
+        never left half written.
+        """
+        path = os.path.join(self.folder, 'runs', self.name(dataset, run) + '.json')
+        record = {'dataset': dataset, 'run': run, 'acc': float(acc), 'err': float(err), 'confusion': np.asarray(confusion).tolist(), 
+                  'seed': seed}
+        with open(path + '.tmp', 'w') as f:
+            json.dump(record, f)
+        os.replace(path + '.tmp', path)
+        shutil.rmtree(self.checkpoint(dataset, run), ignore_errors=True)
+
+
+def run_sweep(folders, runs, epochs, batch, max_ims=1000, image_size=(100,100), processes=None, results='sweep_results', cache=True):
+    """
+    Trains runs independent models on each folder of images concurrently on a pool of processes. Each dataset is read from its image
+    cache (see image_cache.py), which every worker memory-maps, or with cache=False loaded once into shared memory that every worker
+    reads from, and each worker's TensorFlow threads are limited to its share of the cores. Every finished (dataset, run) is recorded
+    in a sweep_store in the folder results and every run is checkpointed each epoch, so rerunning an interrupted sweep skips the
+    finished runs and resumes the partial ones. Returns the test accuracy, loss and confusion matrix of every (dataset, run), also
+    saved to results.npz.
+    """
+    cores = os.cpu_count()
+    if processes is None:
+        processes = min(cores, len(folders) * runs)
+    threads = max(1, cores // processes)
+
+    acc = np.zeros((len(folders), runs))
+    err = np.zeros((len(folders), runs))
+    confusion = np.zeros((len(folders), runs, 2, 2))
+
+    store = sweep_store(results)
+    blocks = []
+    start = time.time()
+    try:
+        # spawned workers start with a fresh TensorFlow runtime rather than a forked copy of this one 
+        with ProcessPoolExecutor(max_workers=processes, mp_context=get_context('spawn'), 
+                                 initializer=_init_sweep_worker, initargs=(threads,)) as pool:
+            futures = []
+            for i, folder in enumerate(folders):
+                todo = []
+                for j in range(runs):
+                    record = store.result(folder, j)
+                    if record is None:
+                        todo.append(j)
+                    else:
+                        acc[i,j], err[i,j], confusion[i,j] = record['acc'], record['err'], record['confusion']
+                if len(todo) == 0:
+                    print('Skipping {}, every run has finished'.format(folder))
+                    continue
+
+                # the images picked from a folder can't depend on which folders were skipped, or a resumed run would change data 
+                print('Loading images from {}...'.format(folder))
+                np.random.seed(i)
+                if cache:
+                    images, labels = load_cached_images(folder, max_ims, image_size)
+                    spec = {'cache': os.path.dirname(images.images.filename), 'order': images.order, 'scale': images.scale}
+                else:
+                    images, labels = load_images(folder, max_ims, image_size)
+                    shm, spec = share_array(images)
+                    blocks.append(shm)
+                del images
+                for j in todo:
+                    futures.append(pool.submit(_sweep_run, i, j, spec, labels, epochs, batch, i * runs + j, store.checkpoint(folder, j)))
+
+            # record each run as soon as it finishes 
+            for future in as_completed(futures):
+                i, j, acc[i,j], err[i,j], confusion[i,j] = future.result()
+                store.save_result(folders[i], j, acc[i,j], err[i,j], confusion[i,j], i * runs + j)
+                print('COMPLETED {} run {}\nTime: {}'.format(folders[i], j, (time.time() - start)))
+    finally:
+        for shm in blocks:
+            shm.close()
+            shm.unlink()
+
+    np.savez(results, folders=np.array(folders), acc=acc, err=err, confusion=confusion)
+    return acc, err, confusion
+
+
 if __name__ == '__main__':
     epochs = 10
     batches = 32 
@@ -123,18 +501,11 @@ if __name__ == '__main__':
     data = ['radiation_test{}'.format(i) for i in tests]
     
     start = time.time()
+    all_acc, all_err, all_confusion = run_sweep(['./'+d for d in data], 10, epochs, batches)
     for i in range(len(data)):
-        res_acc = []
-        res_err = [] 
-        confusion = np.zeros((2,2))
-        print('Loading images...')
-        all_data = load_images('./'+data[i], 1000, (100,100))
-        for j in range(10):
-            acc, err, confusion2 = main(Adam, epochs, batches, 'softmax', all_data)
-            res_acc.append(acc)
-            res_err.append(err)
-            confusion += confusion2
-            print('COMPLETED {} run {}\nTime: {}'.format(data[i], j, (time.time() - start) ))
+        res_acc = list(all_acc[i])
+        res_err = list(all_err[i])
+        confusion = np.sum(all_confusion[i], axis = 0)
         
         # compute the averages and error bars 
         av_acc = sum(res_acc)/len(res_acc)
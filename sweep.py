@@ -0,0 +1,53 @@
+"""
+Command line entry point for the lifetime sweep: creates TPC images of GEANT4 events for a list of electron lifetimes and writes
+them to dataset shards (or JPEGs). Run with no arguments for the lifetime scan that used to be the LArTPC_simulation.py driver:
+
+    python sweep.py --events 0 1 2 --lifetimes 2 10 100 --out lifetime_scan
+"""
+
+import argparse
+from time import time
+from event_store import open_event_store
+from dataset_writer import shard_writer
+from LArTPC_simulation import lifetime_sweep
+
+
+def number(text):
+    # keep whole numbers as ints, so image folders are named lifetime_test10 rather than lifetime_test10.0
+    value = float(text)
+    return int(value) if value.is_integer() else value
+
+
+def main(argv = None):
+
+    parser = argparse.ArgumentParser(description = 'Simulate TPC images of GEANT4 events over a range of electron lifetimes.')
+    parser.add_argument('--events', type = int, nargs = '+', default = [0], help = 'GEANT4 event IDs')
+    parser.add_argument('--lifetimes', type = number, nargs = '+', default = [2,4,6,8,10,15,20,25,30,35,40,45,50,60,70,80,90,100,200,300],
+                        help = 'electron lifetimes in micro seconds')
+    parser.add_argument('--screen', type = float, default = 10, help = 'APA position in mm')
+    parser.add_argument('--t-coef', type = float, default = 7.4e-4, help = 'transverse diffusion coefficient')
+    parser.add_argument('--d-coef', type = float, default = 24e-4, help = 'longitudinal diffusion coefficient')
+    parser.add_argument('--activity', type = float, default = 1e-3, help = 'K-42 decays per module per micro second')
+    parser.add_argument('--binning', default = 'sample', choices = ['sample', 'expected', 'poisson'])
+    parser.add_argument('--seed', type = int, default = 3)
+    parser.add_argument('--store', default = 'event_store', help = 'event store, converted from electron_data.npy on first use')
+    parser.add_argument('--out', default = 'lifetime_scan', help = 'folder of dataset shards')
+    parser.add_argument('--resolution', type = int, nargs = 2, default = None, metavar = ('TIME_BINS', 'WIRES'),
+                        help = 'bin straight onto a coarser output grid, e.g. 100 100 for the CNN, instead of the full 499 x 959')
+    parser.add_argument('--jpeg', action = 'store_true', help = 'save a JPEG per image in lifetime_test{lifetime} folders instead of shards')
+    args = parser.parse_args(argv)
+
+    start = time()
+    store = open_event_store(args.store) # opened once and shared by every event
+    writer = None if args.jpeg else shard_writer(args.out)
+    for event in args.events:
+        lifetime_sweep(event, args.lifetimes, args.screen, args.t_coef, args.d_coef, activity = args.activity, store = store,
+                       binning = args.binning, seed = args.seed, writer = writer, resolution = args.resolution)
+        print('COMPLETED EVENT {} for lifetimes {}'.format(event, args.lifetimes))
+    if writer is not None:
+        writer.close()
+    print(time() - start)
+
+
+if __name__ == '__main__':
+    main()
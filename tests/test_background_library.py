@@ -0,0 +1,41 @@
+"""
+Images with background library tiles overlaid against images with every decay simulated directly.
+"""
+
+import numpy as np
+from background_library import build_library
+from LArTPC_simulation import simulation
+
+
+LIFETIME = 300 # long enough for the depth of the decays to matter 
+
+
+def mean_background(library, num_images = 300):
+    """
+    Mean and standard error of the background charge binned per image of a box-shaped event 1 m deep, 960 mm wide and 10 m long, 
+    which holds about 14 Ar-39 decays per image.
+    """
+
+    event = np.zeros((2,4))
+    event[0,:3] = (-990, -480, -5000)
+    event[1,:3] = (10, 480, 5000)
+
+    charges = []
+    for seed in range(num_images):
+        sim = simulation(event, 10, LIFETIME, 7.4e-4, 24e-4, binning = 'expected', seed = seed, run = False, library = library, pitch = 1.0, 
+                         verbose = False)
+        sim.lifetime_stage(LIFETIME)
+        charges.append(np.sum(sim.layers[1]))
+
+    return np.mean(charges), np.std(charges) / np.sqrt(num_images)
+
+
+def test_library_matches_direct_background(tmp_path):
+    library = build_library(str(tmp_path / 'library'), 300, LIFETIME, 7.4e-4, 24e-4, pitch = 1.0, binning = 'expected')
+
+    direct, direct_err = mean_background(None)
+    overlaid, tiles_err = mean_background(library)
+
+    # the standard errors are about 2% each 
+    assert abs(overlaid - direct) / direct < 0.08
+    assert abs(overlaid - direct) < 3 * np.hypot(direct_err, tiles_err)
@@ -0,0 +1,34 @@
+"""
+Recovery of run_batch from failing tasks and from workers that die.
+"""
+
+import os
+import numpy as np
+import batch_runner
+from batch_runner import make_tasks, run_batch
+
+# file whose absence makes crash_once kill its worker, set by the test 
+MARKER = None
+
+
+def crash_once(key, root_seed, binning):
+    # the first attempt at event 1 kills its worker outright, as an out of memory kill would 
+    if key.event == 1 and not os.path.exists(MARKER):
+        open(MARKER, 'w').close()
+        os._exit(1)
+
+    return np.full((2, 2), key.event, dtype = np.float32)
+
+
+def test_pool_is_rebuilt_after_a_worker_dies(tmp_path, monkeypatch):
+    global MARKER
+    MARKER = str(tmp_path / 'crashed')
+    monkeypatch.setattr(batch_runner, '_run_task', crash_once)
+    monkeypatch.setattr(batch_runner, 'open_event_store', lambda path: None)
+
+    written = []
+    tasks   = make_tasks(range(4), [10], [7.4e-4], [24e-4], [10], [1e-3])
+    failed  = run_batch(tasks, processes = 2, folder = str(tmp_path / 'out'), write = lambda key, image, folder: written.append(key))
+
+    assert failed == []
+    assert written == tasks
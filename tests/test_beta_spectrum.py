@@ -0,0 +1,16 @@
+"""
+Accuracy of the tabulated-CDF beta spectrum sampler against the analytic spectra (radiation_package.beta_spect_check).
+"""
+
+import pytest
+from LArTPC_simulation import radiation_package
+
+
+# largest deviation of a 100 bin density histogram of 10^6 samples from the normalised pdf, relative to its peak; Poisson 
+# fluctuations alone give about 0.02 
+MAX_DEVIATION = 0.04
+
+
+@pytest.mark.parametrize('isotope, q_value', [('Ar39', 0.6), ('K42', 3.5)])
+def test_beta_spectrum_matches_pdf(isotope, q_value):
+    assert radiation_package().beta_spect_check(q_value, num_events = 10**6) < MAX_DEVIATION
@@ -0,0 +1,19 @@
+"""
+Statistical comparison of the analytic expected-charge binning against per-electron sampling (simulation.compare_binning).
+"""
+
+import pytest
+from benchmark import synthetic_electron_data
+from LArTPC_simulation import simulation
+
+
+@pytest.mark.parametrize('seed', [0, 1, 2])
+def test_expected_charge_matches_sampling(seed):
+    rows = synthetic_electron_data(1, 200, seed = 0)
+    sim  = simulation(rows[:,:4], 10, 10, 7.4e-4, 24e-4, seed = seed, run = False, verbose = False)
+    sim.lifetime_stage(sim.lifetime)
+
+    chi2_ndf, charge_diff = sim.compare_binning()
+
+    assert 0.85 < chi2_ndf < 1.15
+    assert abs(charge_diff) < 1e-3
@@ -0,0 +1,138 @@
+"""
+A saved model scores images through the inference service as it did the same images in training, whichever way they were loaded.
+"""
+
+import os
+import numpy as np
+import pytest
+
+pytest.importorskip('tensorflow')
+pytest.importorskip('sklearn')
+
+import matplotlib.pyplot as plt
+from tensorflow.keras.losses import CategoricalCrossentropy
+from tensorflow.keras.optimizers import Adam
+from dataset_writer import shard_writer, NOISE, SN
+from live_generator import to_cnn_input, PREPROCESSING
+from model_utils import CNNModel, load_model
+from inference_service import batcher, cnn_input, image_files
+from run_cnn import load_cached_images, stream_images, image_index, input_preprocessing
+
+IMAGE_SIZE = (20, 20)
+NUM_IMAGES = 8
+
+
+def raw_images(seed = 0):
+    """
+    Small raw ADC images: baseline and noise, with a track-like blob in every other one. Returns them and their labels.
+    """
+
+    rng = np.random.default_rng(seed)
+    images = 500 + 5 * rng.standard_normal((NUM_IMAGES, 60, 80))
+    rows, cols = np.mgrid[:60, :80]
+    for image in images[1::2]:
+        r, c = rng.uniform(10, 50), rng.uniform(10, 70)
+        image += 2000 * np.exp(-0.5 * (((rows - r) / 3)**2 + ((cols - c) / 6)**2))
+    labels = np.array([NOISE, SN] * (NUM_IMAGES // 2))
+
+    return images.astype(np.float32), labels
+
+
+def write_jpegs(folder):
+    images, labels = raw_images()
+    os.makedirs(folder, exist_ok = True)
+    for n, (image, label) in enumerate(zip(images, labels)):
+        plt.imsave(os.path.join(folder, '{}_{}.jpeg'.format('sn' if label == SN else 'noise', n)), image, vmin = 450, vmax = 4091)
+
+
+def write_shards(folder):
+    images, labels = raw_images()
+    with shard_writer(folder) as writer:
+        for image, label in zip(images, labels):
+            writer.append(image, label = label)
+
+
+def streamed(folder):
+    """
+    Test set of stream_images of the folder, its sources in the same order, and the preprocessing.
+    """
+
+    np.random.seed(0)
+    train, valid, test, labels, preprocessing = stream_images(folder, NUM_IMAGES, IMAGE_SIZE, 4, 0.25, 0.25, 0.5)
+    np.random.seed(0)
+    sources = image_index(folder, NUM_IMAGES)[0][NUM_IMAGES // 2:]
+    if isinstance(sources[0], tuple):
+        sources = sorted(sources)
+
+    return np.concatenate([x.numpy() for x, y in test]), sources, preprocessing
+
+
+def training_and_served(kind, tmp_path):
+    """
+    The CNN inputs an image set was trained on, the inputs the service makes of the same images and the preprocessing saved.
+    """
+
+    folder = str(tmp_path / 'images')
+
+    if kind == 'live':
+        images = raw_images()[0]
+        return np.stack([to_cnn_input(image, IMAGE_SIZE) for image in images]), images, PREPROCESSING
+
+    if kind == 'cached jpeg':
+        write_jpegs(folder)
+        np.random.seed(0)
+        x, labels = load_cached_images(folder, NUM_IMAGES, IMAGE_SIZE, str(tmp_path / 'cache'))
+        fnames = sorted(f for f in os.listdir(folder) if f.endswith('.jpeg'))
+        served = [os.path.join(folder, fnames[i]) for i in x.order]
+        return x[np.arange(len(x))], served, input_preprocessing('jpeg', 'pil', x.scale)
+
+    if kind == 'streamed jpeg':
+        write_jpegs(folder)
+        return streamed(folder)
+
+    write_shards(folder)
+    x, sources, preprocessing = streamed(folder)
+    with np.load(sources[0][0]) as shard:
+        images = shard['images']
+
+    return x, [images[i] for path, i in sources], preprocessing
+
+
+@pytest.mark.parametrize('kind', ['live', 'cached jpeg', 'streamed jpeg', 'streamed shards'])
+def test_service_scores_as_in_training(kind, tmp_path):
+    trained, images, preprocessing = training_and_served(kind, tmp_path)
+
+    model = CNNModel(Adam, CategoricalCrossentropy, 2, 'softmax', IMAGE_SIZE)
+    expected = model.predict_proba(trained)
+    model.save_model(str(tmp_path / 'model'), preprocessing)
+
+    loaded, preprocessing = load_model(str(tmp_path / 'model'))
+    if isinstance(images[0], str):
+        served = [next(image_files(path, IMAGE_SIZE, preprocessing))[1] for path in images]
+    else:
+        served = [cnn_input(image, IMAGE_SIZE, preprocessing) for image in images]
+
+    np.testing.assert_allclose(np.stack(served), trained, atol = 1e-5)
+    with batcher(loaded, max_batch = 4) as service:
+        np.testing.assert_allclose(service.score(served), expected, atol = 1e-5)
+
+
+def test_raw_images_are_rendered_for_jpeg_models(tmp_path):
+    folder = str(tmp_path / 'images')
+    write_jpegs(folder)
+    preprocessing = input_preprocessing('jpeg', 'pil', 255)
+
+    for n, image in enumerate(raw_images()[0]):
+        path = [os.path.join(folder, f) for f in os.listdir(folder) if f.endswith('_{}.jpeg'.format(n))][0]
+        from_jpeg = next(image_files(path, IMAGE_SIZE, preprocessing))[1]
+
+        # the same up to the JPEG compression 
+        assert np.mean(np.abs(cnn_input(image, IMAGE_SIZE, preprocessing) - from_jpeg)) < 0.005
+
+
+def test_unknown_preprocessing_only_scores_prepared_images():
+    image = raw_images()[0][0]
+
+    with pytest.raises(ValueError):
+        cnn_input(image, IMAGE_SIZE, None)
+    assert cnn_input(to_cnn_input(image, IMAGE_SIZE), IMAGE_SIZE, None).shape == IMAGE_SIZE + (1,)
@@ -0,0 +1,26 @@
+"""
+Batching of array inputs by ExtraUtils.batches.
+"""
+
+import numpy as np
+import pytest
+
+pytest.importorskip('tensorflow')
+
+from model_utils import ExtraUtils
+from image_cache import packed_images
+
+
+@pytest.mark.parametrize('packed', [False, True])
+def test_batches_follow_idx_order(packed):
+    images = np.arange(10, dtype = np.uint8)[:,None,None] * np.ones((1, 2, 2), dtype = np.uint8)
+    x = packed_images(images, 1) if packed else images
+    y = np.arange(10)
+    idx = np.array([7, 2, 9, 0, 5, 3, 8, 1, 6, 4])
+
+    batches = list(ExtraUtils.batches(None, x, y, 4, idx))
+
+    # labels and images of every batch come in idx order, so predictions line up with y[idx] 
+    np.testing.assert_array_equal(np.concatenate([b[1] for b in batches]), y[idx])
+    np.testing.assert_array_equal(np.concatenate([b[0][:,0,0] for b in batches]).ravel(), idx)
+    assert [len(b[1]) for b in batches] == [4, 4, 2]